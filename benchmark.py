@@ -0,0 +1,166 @@
+from globals import *
+from rating_system import RatingSystem, TaskRecord
+from rating_system_tools import ScoringManager, DifficultyManager, invalidate_all
+from elo import SME_EvE, ELO, MOV
+from skill_points import TMX_const
+import global_leaderboard, players
+import numpy as np, json, tracemalloc, argparse, sys, os, subprocess
+from time import perf_counter
+
+#synthetic leaderboards shaped like the acmp.ru ones, so the pipeline can be measured without dbcache/
+
+def synthetic_data(tasks=1000, players_no=20000, rows=20, zipf_s=1.1, seed=0, lang=Lang.cpp):
+    rng = np.random.default_rng(seed)
+    date_rng = np.random.default_rng(seed+1)    #separate, so adding dates left the leaderboards as they were
+    player_ids = players.intern([f"synthetic player {i}" for i in range(players_no)])
+    participation_cdf = np.cumsum(1 / np.arange(1, players_no+1)**zipf_s)
+    participation_cdf /= participation_cdf[-1]
+    rows = min(rows, players_no)
+
+    data = []
+    for id in range(1, tasks+1):
+        chosen = np.empty(0, dtype=np.int64)
+        while len(chosen) < rows:
+            candidates = np.searchsorted(participation_cdf, rng.random(3*rows))
+            _, first = np.unique(np.concatenate([chosen, candidates]), return_index=True)
+            chosen = np.concatenate([chosen, candidates])[np.sort(first)]
+        chosen = chosen[:rows]
+
+        shortest = int(rng.lognormal(5.0, 0.8)) + 10
+        code_len = np.sort(shortest + rng.integers(0, rng.integers(3, 3*rows), rows)).astype(np.int32)
+        ids = player_ids[chosen]
+        dates = np.datetime64("2010-01-01", "s") + date_rng.integers(0, 10*365*86400, rows).astype("timedelta64[s]")
+        ids.flags.writeable = code_len.flags.writeable = False
+        data.append((TaskInfo(id, lang, int(rng.lognormal(6.0, 1.2))+1), TaskRecord(ids, code_len, dates=dates)))
+    return data
+
+
+def run(tasks=1000, players_no=20000, runs=5, seed=0, repeat=3, memory=True):
+    print(f"generating {tasks} tasks for {players_no} players... ", end="", flush=True)
+    data = synthetic_data(tasks, players_no, seed=seed)
+    print("done")
+    rows = sum(len(r.player_ids) for _, r in data)
+    matches = sum(len(r.player_ids)*(len(r.player_ids)-1)//2 for _, r in data)
+    offsets = np.cumsum([0]+[len(r.code_len) for _, r in data])
+    code_len = np.concatenate([r.code_len for _, r in data])
+    scored = [(t, r._replace(scores=ScoringManager().get_scores(r))) for t, r in data]
+    kernel = SME_EvE(ELO())
+
+    stages = {
+        "ScoringManager.get_scores":       (lambda: [ScoringManager().get_scores(r) for _, r in data],      {"tasks": tasks}),
+        "ScoringManager.get_scores_batch": (lambda: ScoringManager().get_scores_batch(offsets, code_len),   {"tasks": tasks}),
+        "DifficultyManager.precompute":    (lambda: DifficultyManager().precompute(data),                   {"tasks": tasks}),
+        "SME_EvE._get_rating_deltas":      (lambda: [kernel._get_rating_deltas(50.0, r.scores, np.full(len(r.scores), 1500.0)) for _, r in scored], {"tasks": tasks, "matches": matches}),
+        "RatingSystem.rate SME_EvE":       (lambda: RatingSystem(SME_EvE(MOV())).rate(data),                {"tasks": tasks, "matches": matches}),
+        "RatingSystem.rate TMX_const":     (lambda: RatingSystem(TMX_const()).rate(data),                   {"tasks": tasks}),
+        "rate_multiple_runs SME_EvE":      (lambda: RatingSystem(SME_EvE(MOV())).rate_multiple_runs(data, runs, seed=seed), {"tasks": tasks*runs, "matches": matches*runs}),
+        "global_leaderboard.calc":         (lambda: global_leaderboard.calc_from_data(data, [
+                                                RatingSystem(SME_EvE(MOV()), description="Elo"),
+                                                RatingSystem(TMX_const(), description="Skill points"),
+                                            ], global_leaderboard.LeaderboardOptions(runs=runs)), {"tasks": 2*tasks*runs, "rows": rows}),
+    }
+
+    results = {}
+    for name, (f, units) in stages.items():
+        seconds = float("inf")
+        for _ in range(repeat):
+            invalidate_all()
+            start = perf_counter()
+            f()
+            seconds = min(seconds, perf_counter() - start)
+        results[name] = {"seconds": seconds, **{f"{unit}/s": n/seconds for unit, n in units.items()}}
+        if memory:
+            invalidate_all()
+            tracemalloc.start()
+            f()
+            results[name]["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    return {"config": {"tasks": tasks, "players": players_no, "runs": runs, "seed": seed, "repeat": repeat}, "stages": results}
+
+def print_report(report) -> None:
+    print(f"\n{'stage':<36} {'time':>10} {'peak mem':>10}   throughput")
+    for name, r in report["stages"].items():
+        throughput = "  ".join(f"{v:>12,.0f} {k}" for k, v in r.items() if k.endswith("/s"))
+        peak = f"{r['peak_mb']:>8.1f}MB" if "peak_mb" in r else ""
+        print(f"{name:<36} {r['seconds']:>9.3f}s {peak:>10}   {throughput}")
+
+def compare(report, baseline, tolerance=0.25) -> list:
+    """names of stages that got slower than baseline by more than tolerance"""
+    if report["config"] != baseline["config"]:
+        print(f"warning: baseline was recorded with {baseline['config']}, current run is {report['config']}")
+    regressions = []
+    print(f"\n{'stage':<36} {'baseline':>10} {'current':>10} {'ratio':>8}")
+    for name, r in report["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        ratio = r["seconds"] / baseline["stages"][name]["seconds"]
+        flag = "  REGRESSION" if ratio > 1+tolerance else ""
+        print(f"{name:<36} {baseline['stages'][name]['seconds']:>9.3f}s {r['seconds']:>9.3f}s {ratio:>7.2f}x{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+#modules a text-only query must not drag in
+_LAZY_MODULES = ["matplotlib", "trueskill", "requests"]
+
+def startup(command=("leaderboard", "-n", "10"), top=8) -> dict:
+    """runs cli.py command under -X importtime (from the current directory, so it sees dbcache/ there)"""
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+    start = perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", cli, *command], capture_output=True, text=True)
+    wall = perf_counter() - start
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((name[1:], int(self_us), int(cumulative_us)))
+    if proc.returncode:
+        print(f"warning: cli.py {' '.join(command)} exited with {proc.returncode}:\n{proc.stderr.splitlines()[-1]}")
+    top_level = sorted([(name, cumulative) for name, _, cumulative in imports if not name.startswith(" ")], key=lambda x: -x[1])
+    return {
+        "command": list(command),
+        "wall_seconds": wall,
+        "import_seconds": sum(self_us for _, self_us, _ in imports) / 1e6,
+        "slowest_imports": {name: cumulative/1e6 for name, cumulative in top_level[:top]},
+        "lazy_modules_imported": [m for m in _LAZY_MODULES if any(name.strip() == m for name, _, _ in imports)],
+    }
+
+def print_startup(report) -> None:
+    print(f"cli.py {' '.join(report['command'])}: {report['wall_seconds']:.3f}s wall, {report['import_seconds']:.3f}s importing")
+    for name, seconds in report["slowest_imports"].items():
+        print(f"    {name:<30} {seconds:>7.3f}s")
+    if report["lazy_modules_imported"]:
+        print(f"imported although not needed: {', '.join(report['lazy_modules_imported'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="times the rating pipeline on synthetic leaderboards")
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=20000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="each stage reports its fastest of this many timings")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--compare", metavar="FILE", help="fail if a stage is slower than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--startup", action="store_true", help="time the startup of a text-only cli query instead")
+    parser.add_argument("--startup-budget", type=float, default=1.0, help="seconds of wall time --startup may take")
+    args = parser.parse_args()
+
+    if args.startup:
+        report = startup()
+        print_startup(report)
+        sys.exit(1 if report["wall_seconds"] > args.startup_budget or report["lazy_modules_imported"] else 0)
+
+    report = run(args.tasks, args.players, args.runs, args.seed, args.repeat, memory=not args.no_memory)
+    print_report(report)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(report, json.load(f), args.tolerance):
+                sys.exit(1)
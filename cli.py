@@ -0,0 +1,143 @@
+import argparse, sys
+from globals import Lang
+
+#modules are imported inside the commands so that e.g. a text-only leaderboard query
+#doesn't pay for matplotlib, trueskill or the rating systems it never touches
+
+def _leaderboard(args):
+    import pandas as pd, database
+    pd.options.display.float_format = "{:.2f}".format
+    if args.player:
+        print(database.get_global_leaderboard_row(args.player))
+    elif args.plot:
+        import main
+        main.show_global_leaderboard(n=args.n)
+    else:
+        print(database.get_global_leaderboard().head(args.n))
+
+def _update(args):
+    import main, os
+    main.update(args.plot, main.LeaderboardOptions(workers=os.cpu_count(), incremental=not args.full, langs=tuple(Lang[l] for l in args.lang or ["cpp"]),
+        chronological=args.chronological, tolerance=args.tolerance, top=args.top))
+
+def _history(args):
+    import main
+    main.show_rating_history(args.names, args.as_of, args.n, Lang[args.lang], args.plot)
+
+def _task(args):
+    import main
+    main.show_leaderboard(args.id, reload=args.reload, plot=args.plot)
+
+def _rivalry(args):
+    import main
+    main.show_rivalry(args.name1, args.name2, args.n)
+
+def _worst(args):
+    import main
+    main.show_worst(args.n, args.name)
+
+def _potentials(args):
+    import main
+    main.show_potentials(args.n, args.name)
+
+def _evaluate(args):
+    import main
+    main.evaluate()
+
+def _sweep(args):
+    import parameter_sweep as ps
+    make_system, space = {"elo": (ps.elo_system, ps.ELO_SPACE), "tmx": (ps.tmx_system, ps.TMX_SPACE)}[args.system]
+    candidates = ps.random_search(ps.as_ranges(space), args.random, args.seed) if args.random else ps.grid(space)
+    results = ps.sweep(make_system, candidates, args.name or f"{args.system}_{'random' if args.random else 'grid'}",
+        tasks=args.tasks, runs=args.runs, folds=args.folds, workers=args.workers, seed=args.seed)
+    ps.print_report(results, args.n)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py", description="acmp.ru leaderboards and ratings")
+    parser.add_argument("--report", metavar="FILE", help="write timings and counters as json instead of printing them")
+    parser.add_argument("--profile", action="store_true", help="run under cProfile and report the slowest functions")
+    parser.add_argument("--sample", type=float, metavar="SECONDS", help="sample the call stack every SECONDS, cheaper than --profile")
+    parser.add_argument("--debug", action="append", default=[], choices=["diff", "leaderboard", "sme"], help="debug printout, can be repeated")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("update", help="refresh stale leaderboards and the global leaderboard")
+    p.add_argument("--full", action="store_true", help="rebuild the global leaderboard from scratch")
+    p.add_argument("--lang", action="append", choices=[l.name for l in Lang], help="can be repeated, ratings get per-language columns (default cpp)")
+    p.add_argument("--plot", action="store_true")
+    p.add_argument("--chronological", action="store_true", help="replay Elo in submission order instead of averaging shuffled runs: one update per submission date of a task, several times cheaper than 100 runs")
+    p.add_argument("--tolerance", type=float, help="stop the shuffled runs once every rating's standard error is at most this")
+    p.add_argument("--top", type=int, help="stop the shuffled runs once the order of the top N stops changing")
+    p.set_defaults(func=_update)
+
+    p = commands.add_parser("history", help="Elo replayed in submission order: leaderboard as of a date, players' trajectories")
+    p.add_argument("names", nargs="*", help="players whose trajectories to plot")
+    p.add_argument("--as-of", help="date of the leaderboard, e.g. 2021-10-18 (default the latest submission)")
+    p.add_argument("-n", type=int, default=50)
+    p.add_argument("--lang", choices=[l.name for l in Lang], default="cpp")
+    p.add_argument("--plot", action="store_true")
+    p.set_defaults(func=_history)
+
+    p = commands.add_parser("leaderboard", help="print the global leaderboard")
+    p.add_argument("-n", type=int, default=50)
+    p.add_argument("--player", help="only this player's row")
+    p.add_argument("--plot", action="store_true")
+    p.set_defaults(func=_leaderboard)
+
+    p = commands.add_parser("task", help="print one task's leaderboard with scores and points")
+    p.add_argument("id", type=int)
+    p.add_argument("--reload", action="store_true", help="download the leaderboard again")
+    p.add_argument("--plot", action="store_true")
+    p.set_defaults(func=_task)
+
+    p = commands.add_parser("rivalry", help="head-to-head of two players")
+    p.add_argument("name1")
+    p.add_argument("name2")
+    p.add_argument("-n", type=int, default=200)
+    p.set_defaults(func=_rivalry)
+
+    p = commands.add_parser("worst", help="a player's weakest tasks")
+    p.add_argument("name")
+    p.add_argument("-n", type=int, default=300)
+    p.set_defaults(func=_worst)
+
+    p = commands.add_parser("potentials", help="hardest tasks and whether a player solved them")
+    p.add_argument("name")
+    p.add_argument("-n", type=int, default=100)
+    p.set_defaults(func=_potentials)
+
+    p = commands.add_parser("evaluate", help="evaluate the rating systems configured in main.evaluate")
+    p.set_defaults(func=_evaluate)
+
+    p = commands.add_parser("sweep", help="search rating system parameters, resuming from earlier results")
+    p.add_argument("system", choices=["elo", "tmx"])
+    p.add_argument("--random", type=int, metavar="N", help="N random candidates within the grid's span instead of the grid")
+    p.add_argument("--name", help="results file in dbcache/sweeps (default <system>_grid or <system>_random)")
+    p.add_argument("--tasks", type=int, default=1000)
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--folds", type=int, default=0)
+    p.add_argument("--workers", type=int)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("-n", type=int, default=20)
+    p.set_defaults(func=_sweep)
+    return parser
+
+def run(argv=None) -> None:
+    args = make_parser().parse_args(argv)
+    if not (args.report or args.profile or args.sample or args.debug):
+        args.func(args)
+        return
+    import instrumentation
+    instrumentation.enable(args.profile, args.sample, args.debug)
+    try:
+        args.func(args)
+    finally:
+        instrumentation.disable()
+        if args.report:
+            instrumentation.save_report(args.report)
+        else:
+            instrumentation.print_report()
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -1,53 +1,229 @@
-from globals import TaskInfo
-import network, global_leaderboard
-import pandas as pd, pickle, atexit, os
+from globals import TaskInfo, Lang
+import network, global_leaderboard, players, rating_system_tools
+from leaderboard_store import LeaderboardStore
+from player_index import PlayerIndex
+from durable import atomic_write, WriteAheadLog
+import instrumentation
+from rating_system_tools import TaskRecord
+import pandas as pd, numpy as np, pickle, atexit, os, shutil, time, json
 
-_LEADERBOARD_CACHE_FILENAME = "dbcache/leaderboards_cache.h5"
+_LEADERBOARD_CACHE_DIRNAME = "dbcache/leaderboards"      #one store per language in a subdirectory
+_LEGACY_LEADERBOARD_CACHE_FILENAME = "dbcache/leaderboards_cache.h5"
 _AC_SUB_CACHE_FILENAME = "dbcache/ac_sub_cache.p"
+_FETCH_TIMES_FILENAME = "dbcache/fetch_times.p"
 _GLOBAL_LEADERBOARD_CACHE_FILENAME = "dbcache/global_leaderboard_cache.h5"
-def _init_leaderboards_cache():
-    return pd.HDFStore(_LEADERBOARD_CACHE_FILENAME, complevel=7, complib='zlib')
+_GLOBAL_LEADERBOARD_STATE_FILENAME = "dbcache/global_leaderboard_state.p"
+_PLAYER_INDEX_FILENAME = "dbcache/player_index.p"
+_WAL_FILENAME = "dbcache/cache.wal"                 #ac_sub and fetch time changes since the pickles were last written
+_FETCH_CHECKPOINT_FILENAME = "dbcache/fetch_in_progress"
+_TASK_CATALOGUE_FILENAME = "dbcache/task_catalogue.p"     #id, name, acc_no and task list page of every known task
+def _migrate_leaderboards_cache():
+    """splits a single-store cache (or the legacy h5 one) into per-language stores"""
+    unpartitioned = LeaderboardStore(_LEADERBOARD_CACHE_DIRNAME) if os.path.exists(os.path.join(_LEADERBOARD_CACHE_DIRNAME, "CURRENT")) else None
+    if unpartitioned is None and (_partitions_on_disk() or not os.path.exists(_LEGACY_LEADERBOARD_CACHE_FILENAME)):
+        return
+    source = _LEADERBOARD_CACHE_DIRNAME if unpartitioned is not None else _LEGACY_LEADERBOARD_CACHE_FILENAME
+    print(f"migrating {source} to per-language stores in {_LEADERBOARD_CACHE_DIRNAME}... ", end="", flush=True)
+    if unpartitioned is not None:
+        for key in unpartitioned.task_keys():
+            _store(_lang_of_key(key))[key] = unpartitioned[key]
+    else:
+        with pd.HDFStore(_LEGACY_LEADERBOARD_CACHE_FILENAME, mode='r') as legacy:
+            for key in legacy.keys():
+                _store(_lang_of_key(key.lstrip('/')))[key.lstrip('/')] = legacy[key]
+    for store in _leaderboards_caches.values():
+        store.commit()
+    if unpartitioned is not None:
+        os.remove(os.path.join(_LEADERBOARD_CACHE_DIRNAME, "CURRENT"))
+        shutil.rmtree(os.path.join(_LEADERBOARD_CACHE_DIRNAME, unpartitioned.generation), ignore_errors=True)
+    print("success")
+
+def _store(lang:Lang) -> LeaderboardStore:
+    store = _leaderboards_caches.get(lang)
+    if store is None:
+        store = _leaderboards_caches[lang] = LeaderboardStore(os.path.join(_LEADERBOARD_CACHE_DIRNAME, lang.name))
+    return store
+
+def _partitions_on_disk():
+    return [lang for lang in Lang if os.path.exists(os.path.join(_LEADERBOARD_CACHE_DIRNAME, lang.name, "CURRENT"))]
 
-_leaderboards_cache = _init_leaderboards_cache()
-_ac_sub_cache = {}
+def _lang_of_key(key) -> Lang:
+    return Lang[key.rstrip("0123456789")]
 
+#opened on first use, so importing database costs nothing until a leaderboard is actually needed;
+#a language's store is only opened once one of its leaderboards is
+_opened = False
+_leaderboards_caches = {}
+_player_index = None
+_ac_sub_cache = None
+_fetch_times = None
+_task_catalogue = None
+_walked_ac_sub = {}   #acc_no of every task on the task list pages this process walked, see fetch
+_wal = WriteAheadLog(_WAL_FILENAME)
+
+def _open_database():
+    global _opened, _ac_sub_cache, _fetch_times, _task_catalogue
+    if _opened:
+        return
+    _opened = True
+    _migrate_leaderboards_cache()
+    _ac_sub_cache = _load_pickle(_AC_SUB_CACHE_FILENAME)
+    _fetch_times = _load_pickle(_FETCH_TIMES_FILENAME)
+    _task_catalogue = _load_pickle(_TASK_CATALOGUE_FILENAME)
+    if not isinstance(_task_catalogue, pd.DataFrame):
+        _task_catalogue = pd.DataFrame({"id": [], "name": [], "acc_no": [], "page": []})
+    for record in _wal.replay():
+        _ac_sub_cache.update({int(id): n for id, n in record.get("ac_sub", {}).items()})
+        _fetch_times.update(record.get("fetch_times", {}))
+    atexit.register(_close_database)
 
-def prepare_cache(task_info_list):
-    _update_leaderboards_cache(task_info_list)
+def _load_pickle(filename) -> dict:
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+FETCH_WORKERS = 16
+PARSE_WORKERS = 0     #processes parsing downloaded pages, 0 parses them on the download threads
+LEADERBOARD_TTL = 30*24*60*60 #seconds
+CHECKPOINT_EVERY = 50 #downloaded leaderboards between commits; grows with the store (see _store_leaderboard)
+DISCOVERY_BATCH = 4   #task list pages requested at once while looking for new tasks
+
+def prepare_cache(task_info_list, workers=FETCH_WORKERS):
+    _open_database()
+    _update_leaderboards_cache(task_info_list, workers)
     _update_ac_sub_cache([t.id for t in task_info_list])
 
-def fetch(task_info_list) -> None:
-    global _leaderboards_cache
-    _leaderboards_cache.close()
-    os.remove(_LEADERBOARD_CACHE_FILENAME)
-    _leaderboards_cache = _init_leaderboards_cache()
-    _ac_sub_cache.clear()
-    prepare_cache(task_info_list)
+def fetch(task_info_list, workers=FETCH_WORKERS) -> None:
+    """downloads everything from scratch; if a previous fetch of the same tasks was interrupted,
+    it is resumed from its last checkpoint instead"""
+    _open_database()
+    rating_system_tools.invalidate_all()
+    keys = sorted(str(t) for t in task_info_list)
+    if _load_fetch_checkpoint() == keys:
+        print(f"resuming interrupted fetch, {sum(_is_cached(t) for t in task_info_list)} of {len(keys)} leaderboards already there")
+    else:
+        for lang in {t.lang for t in task_info_list}:
+            _store(lang).clear()
+        _commit_leaderboards()
+        _ac_sub_cache.clear()
+        _fetch_times.clear()
+        os.makedirs(os.path.dirname(_FETCH_CHECKPOINT_FILENAME), exist_ok=True)
+        _compact()
+        #the catalogue walk just read these off the task list pages, no need to download them again
+        ids = {t.id for t in task_info_list}
+        _set_ac_sub({id: n for id, n in _walked_ac_sub.items() if id in ids})
+        atomic_write(_FETCH_CHECKPOINT_FILENAME, lambda f: f.write(json.dumps(keys).encode()))
+    prepare_cache(task_info_list, workers)
+    os.remove(_FETCH_CHECKPOINT_FILENAME)
+
+def refresh(task_info_list, ttl=LEADERBOARD_TTL, workers=FETCH_WORKERS) -> list:
+    """re-downloads only leaderboards whose accepted count changed or which are older than ttl;
+    the current cache stays readable until the new one is committed"""
+    _open_database()
+    fresh_ac_sub = _download_ac_sub({t.id for t in task_info_list})
+    stale = [t for t in task_info_list if _is_stale(t, fresh_ac_sub[t.id], ttl)]
+    print(f"refresh: {len(stale)} of {len(task_info_list)} leaderboards are stale")
+
+    for task_info, leaderboard in network.get_task_leaderboards(stale, workers, PARSE_WORKERS):
+        _store_leaderboard(task_info, leaderboard)
+        rating_system_tools.invalidate_task(task_info)
+    _commit_leaderboards()
+
+    _set_ac_sub(fresh_ac_sub)
+    return stale
 
 def update_one_task(task_info:TaskInfo) -> None:
-    if str(task_info) in _leaderboards_cache:
-        del _leaderboards_cache[str(task_info)]
+    _open_database()
+    rating_system_tools.invalidate_task(task_info)
+    if _is_cached(task_info):
+        del _store(task_info.lang)[str(task_info)]
     if task_info.id in _ac_sub_cache:
         del _ac_sub_cache[task_info.id]
     get_task_leaderboard(task_info)
     get_accepted_submissions(task_info.id)
+    _commit_leaderboards()
 
 def get_task_leaderboard(task_info:TaskInfo):
-    key = str(task_info)
-    if key not in _leaderboards_cache:
-        _leaderboards_cache[key] = network.get_task_leaderboard(task_info)
+    _open_database()
+    if not _is_cached(task_info):
+        instrumentation.count("leaderboard cache misses")
+        _store_leaderboard(task_info, network.get_task_leaderboard(task_info))
+    else:
+        instrumentation.count("leaderboard cache hits")
+
+    return _store(task_info.lang)[str(task_info)]
 
-    return _leaderboards_cache[key]
+def get_task_record(task_info:TaskInfo) -> TaskRecord:
+    _open_database()
+    get_task_leaderboard(task_info)
+    _commit_leaderboards()
+    return _make_record(task_info)
+
+def get_rating_data(task_ids, lang=Lang.cpp):
+    """(task_info, TaskRecord) pairs for the rating pipeline"""
+    _open_database()
+    _update_ac_sub_cache(task_ids)
+    task_infos = [TaskInfo(id, lang, get_accepted_submissions(id)) for id in task_ids]
+    for task_info in task_infos:
+        get_task_leaderboard(task_info)
+    _commit_leaderboards()
+    with instrumentation.span("cache read"):
+        return [(task_info, _make_record(task_info)) for task_info in task_infos]
 
 def get_accepted_submissions(task_no):
+    _open_database()
     if task_no not in _ac_sub_cache:
         _update_ac_sub_cache([task_no])
 
     return _ac_sub_cache[task_no]
 
-def construct_global_leaderboard(rat_systems, runs):
-    gl = global_leaderboard.calc(list(range(1,1001)), rat_systems, runs)
-    gl.to_hdf(_GLOBAL_LEADERBOARD_CACHE_FILENAME, "gl", complevel=7, complib='zlib')
+def get_task_ids(refresh:bool=False) -> list:
+    """ids of all tasks in the catalogue; it is discovered from the task list pages on first use,
+    refresh=True looks for tasks added since"""
+    _open_database()
+    if refresh or not len(_task_catalogue.index):
+        _refresh_task_catalogue()
+    return _task_catalogue["id"].tolist()
+
+def get_task_catalogue() -> pd.DataFrame:
+    get_task_ids()
+    return _task_catalogue.copy()
+
+#options.incremental reuses the state of the last construction, see global_leaderboard.calc_incremental
+def construct_global_leaderboard(rat_systems, options=None):
+    options = options or global_leaderboard.LeaderboardOptions()
+    state = None
+    if options.incremental:
+        try:
+            with open(_GLOBAL_LEADERBOARD_STATE_FILENAME, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            print("no global leaderboard state yet, rebuilding from scratch")
+        except (AttributeError, ImportError):
+            print("global leaderboard state was written by an incompatible version, rebuilding from scratch")
+    gl, state = global_leaderboard.calc_incremental(get_task_ids(), rat_systems, state, options)
+    gl.to_hdf(_GLOBAL_LEADERBOARD_CACHE_FILENAME+".tmp", key="gl", mode='w', complevel=7, complib='zlib')
+    os.replace(_GLOBAL_LEADERBOARD_CACHE_FILENAME+".tmp", _GLOBAL_LEADERBOARD_CACHE_FILENAME)
+    atomic_write(_GLOBAL_LEADERBOARD_STATE_FILENAME, lambda f: pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+def get_player_index() -> PlayerIndex:
+    """player -> tasks postings over the leaderboard caches of all languages,
+    loaded on first use and rebuilt if out of date"""
+    global _player_index
+    _open_database()
+    if _player_index is None:
+        try:
+            with open(_PLAYER_INDEX_FILENAME, 'rb') as f:
+                _player_index = pickle.load(f)
+        except FileNotFoundError:
+            _player_index = PlayerIndex()
+    stores = [_store(lang) for lang in set(_partitions_on_disk()) | set(_leaderboards_caches)]
+    if getattr(_player_index, "generations", None) != {store.path: store.generation for store in stores}:
+        _player_index.rebuild(stores)
+    return _player_index
 
 def get_global_leaderboard():
     _global_leaderboard = pd.read_hdf(_GLOBAL_LEADERBOARD_CACHE_FILENAME, "gl")
@@ -59,35 +235,141 @@ def get_global_leaderboard_row(name):
 
 
 
-def _update_leaderboards_cache(task_info_list):
-    for task_info in task_info_list:
-        get_task_leaderboard(task_info)
+def _update_leaderboards_cache(task_info_list, workers=FETCH_WORKERS):
+    missing = [t for t in task_info_list if not _is_cached(t)]
+    instrumentation.count("leaderboard cache hits", len(task_info_list)-len(missing))
+    instrumentation.count("leaderboard cache misses", len(missing))
+    if workers <= 1:
+        for task_info in missing:
+            get_task_leaderboard(task_info)
+    else:
+        #downloads run concurrently, the store is only ever written from this thread
+        for task_info, leaderboard in network.get_task_leaderboards(missing, workers, PARSE_WORKERS):
+            _store_leaderboard(task_info, leaderboard)
+    _commit_leaderboards()
+
+_unlogged_fetch_times = {}
+def _store_leaderboard(task_info:TaskInfo, leaderboard) -> None:
+    key = str(task_info)
+    _store(task_info.lang)[key] = leaderboard
+    _fetch_times[key] = _unlogged_fetch_times[key] = time.time()
+    #every commit rewrites a whole store, so checkpoints get sparser as it grows to keep a long fetch linear
+    if len(_unlogged_fetch_times) >= max(CHECKPOINT_EVERY, len(_store(task_info.lang).keys)//4):
+        _commit_leaderboards()
+
+def _commit_leaderboards():
+    """checkpoint: staged leaderboards become new store generations, then their fetch times go to the log"""
+    index = get_player_index() if _player_index is not None or os.path.exists(_PLAYER_INDEX_FILENAME) else None
+    for store in list(_leaderboards_caches.values()):
+        changed = store.commit()
+        if index is not None:
+            index.update(store, changed)
+    if _unlogged_fetch_times:
+        _wal.append({"fetch_times": _unlogged_fetch_times})
+        _unlogged_fetch_times.clear()
+
+def _is_cached(task_info:TaskInfo) -> bool:
+    return str(task_info) in _store(task_info.lang)
+
+def _make_record(task_info:TaskInfo) -> TaskRecord:
+    store = _store(task_info.lang)
+    rows = store.task_rows(str(task_info))
+    player_ids = _get_player_id_map(store)[store.columns["name_id"][rows]]
+    player_ids.flags.writeable = False
+    return TaskRecord(player_ids, store.columns["code_len"][rows], dates=store.columns["date"][rows])
+
+_player_id_maps = {}
+def _get_player_id_map(store:LeaderboardStore) -> np.ndarray:
+    """store name id -> process-wide player id, shared by all languages;
+    rebuilt when a new store generation is committed"""
+    names, id_map = _player_id_maps.get(store.path, (None, None))
+    if names is not store.names:
+        names, id_map = _player_id_maps[store.path] = (store.names, players.intern(store.names.tolist()))
+    return id_map
 
 def _update_ac_sub_cache(id_list):
-    id_list = [id for id in id_list if id not in _ac_sub_cache]
+    id_list = list({id for id in id_list if id not in _ac_sub_cache})
     if not len(id_list):
         return
-    TASKS_PER_PAGE = 50
-    def get_page(id):
-        return (id-1)//TASKS_PER_PAGE
-    pages = { get_page(id) for id in id_list }
-    table = network.get_accepted_submissions(pages)
+    _set_ac_sub(_download_ac_sub(id_list))
+
+def _set_ac_sub(ac_sub) -> None:
+    _ac_sub_cache.update(ac_sub)
+    _wal.append({"ac_sub": {str(id): int(n) for id, n in ac_sub.items()}})
+
+def _download_ac_sub(id_list):
+    """downloads only the task list pages the catalogue places id_list on"""
+    if not set(id_list) <= set(get_task_ids()):
+        _refresh_task_catalogue()
+    pages = _task_catalogue.set_index("id")["page"]
+    table = network.get_accepted_submissions(sorted({int(pages[id]) for id in id_list if id in pages.index}))
     table = table[table["id"].isin(id_list)]
-    assert(len(table.index)==len(id_list))
-    _ac_sub_cache.update(zip(table["id"], table["acc_no"]))
+    assert(len(table.index)==len(id_list)), f"tasks not found in the task list: {set(id_list) - set(table['id'])}"
+    return dict(zip(table["id"], table["acc_no"]))
 
-def _close_database():
-    _leaderboards_cache.close()
-    with open(_AC_SUB_CACHE_FILENAME, 'wb') as f:
-        pickle.dump(_ac_sub_cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+def _refresh_task_catalogue() -> None:
+    """new tasks are appended to the last pages, so the walk starts from the last known page,
+    fetching DISCOVERY_BATCH pages at a time until one is empty or repeats tasks already seen"""
+    global _task_catalogue
+    page = int(_task_catalogue["page"].max()) if len(_task_catalogue.index) else 0
+    seen, found = set(), []
+    while True:
+        tables = dict(network.get_task_list_pages(range(page, page+DISCOVERY_BATCH), DISCOVERY_BATCH))
+        for page in range(page, page+DISCOVERY_BATCH):
+            table = tables[page][~tables[page]["id"].isin(seen)]
+            if not len(table.index):
+                break
+            seen.update(table["id"])
+            found.append(table[["id", "name", "acc_no"]].assign(page=page))
+        else:
+            page += 1
+            continue
+        break
 
+    walked = pd.concat(found) if found else _task_catalogue.iloc[:0]
+    new = walked[~walked["id"].isin(_task_catalogue["id"])]
+    _task_catalogue = pd.concat([_task_catalogue[~_task_catalogue["id"].isin(walked["id"])], walked]).sort_values("id", ignore_index=True)
+    _task_catalogue = _task_catalogue.astype({"id": np.int64, "acc_no": np.int64, "page": np.int64})
+    if len(new.index):
+        print(f"task catalogue: {len(new.index)} new tasks, {len(_task_catalogue.index)} in total")
+    _walked_ac_sub.update((int(id), int(n)) for id, n in zip(walked["id"], walked["acc_no"]))
+    #acc_no of tasks never seen before comes for free; known ones are left to refresh's staleness check
+    unknown = {int(id): int(n) for id, n in zip(walked["id"], walked["acc_no"]) if id not in _ac_sub_cache}
+    if unknown:
+        _set_ac_sub(unknown)
+    os.makedirs(os.path.dirname(_TASK_CATALOGUE_FILENAME), exist_ok=True)
+    atomic_write(_TASK_CATALOGUE_FILENAME, lambda f: pickle.dump(_task_catalogue, f, protocol=pickle.HIGHEST_PROTOCOL))
 
+def _is_stale(task_info:TaskInfo, fresh_ac_sub, ttl) -> bool:
+    key = str(task_info)
+    if not _is_cached(task_info) or _ac_sub_cache.get(task_info.id) != fresh_ac_sub:
+        return True
+    fetched = _fetch_times.get(key)
+    if fetched is None:
+        #leaderboards cached before fetch times were tracked are as old as the legacy cache
+        legacy = _LEGACY_LEADERBOARD_CACHE_FILENAME
+        fetched = os.path.getmtime(legacy) if os.path.exists(legacy) else 0.0
+    return time.time() - fetched > ttl
+
+def _load_fetch_checkpoint():
+    try:
+        with open(_FETCH_CHECKPOINT_FILENAME, 'rb') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
 
+def _compact():
+    """folds the log into the pickles; nothing is lost if this is interrupted, the log is replayed again"""
+    dump = lambda obj: lambda f: pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    atomic_write(_AC_SUB_CACHE_FILENAME, dump(_ac_sub_cache))
+    atomic_write(_FETCH_TIMES_FILENAME, dump(_fetch_times))
+    _wal.truncate()
 
-try:
-    with open(_AC_SUB_CACHE_FILENAME, 'rb') as f:
-        _ac_sub_cache = pickle.load(f)
-except FileNotFoundError:
-    _ac_sub_cache = {}
+def _close_database():
+    _commit_leaderboards()
+    if not os.path.isdir(os.path.dirname(_AC_SUB_CACHE_FILENAME)):
+        return
+    _compact()
+    if _player_index is not None:
+        atomic_write(_PLAYER_INDEX_FILENAME, lambda f: pickle.dump(_player_index, f, protocol=pickle.HIGHEST_PROTOCOL))
 
-atexit.register(_close_database)
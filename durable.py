@@ -0,0 +1,51 @@
+import os, json
+
+#writes that survive a crash or kill: a file is either the old version or the new one, never half of each
+
+def atomic_write(filename, write) -> None:
+    """write(f) fills a temp file which is fsynced and renamed over filename"""
+    tmp = filename + ".tmp"
+    with open(tmp, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+    fsync_dir(os.path.dirname(filename))
+
+def fsync_dir(path) -> None:
+    """makes renames and new files in path durable"""
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    """append-only file of json records; a torn last line from a crash is ignored on replay"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def append(self, record) -> None:
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        with open(self.filename, 'a', encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self) -> list:
+        records = []
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def truncate(self) -> None:
+        if os.path.exists(self.filename):
+            atomic_write(self.filename, lambda f: None)
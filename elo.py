@@ -1,8 +1,7 @@
 import helpers as hlp
-from rating_system import Rating, RatingSystemLogic, DifficultyManager
+from rating_system import Rating, RatingSystemLogic, DifficultyManager, TaskRecord
 from globals import *
-import statistics, pandas as pd
-from typing import List
+import numpy as np, instrumentation
 
 
 class EloRating(Rating):
@@ -27,13 +26,33 @@ class ELO:
         exp = self._get_estimate(rat_a, rat_b)
         k = self.k * hlp.interpolate(task_diff, *DifficultyManager._DIFF_RANGE, 0.0, 1.0)
         dr = k  * (outcome - exp)
-        if PRINT_SME:
+        instrumentation.count("match evaluations")
+        if instrumentation.debug_sme:
             print(f"Match (rank={float(rat_a):>8.2f}) {outcome:.1f} vs (rank={float(rat_b):>8.2f}): exp={exp:.2f} k={k:.2f} dr={dr:>10.3f}")
         return dr
     
     def _get_estimate(self, rat_a:float, rat_b:float):
         return 1 / ( 1 + 10**(-(float(rat_a)-float(rat_b))/self.sigma) )
 
+    #array versions: element-wise over matches, same arithmetic as the scalar ones
+    def get_outcomes(self, scores_a:np.ndarray, scores_b:np.ndarray) -> np.ndarray:
+        return np.where(scores_a < scores_b, 1.0, np.where(scores_a > scores_b, 0.0, 0.5))
+
+    def get_drs(self, rats_a:np.ndarray, rats_b:np.ndarray, task_diff:float, outcomes:np.ndarray, matches:np.ndarray=None) -> np.ndarray:
+        """matches flags the entries that are matches of their own, for counting and printing; all by default"""
+        exp = self._get_estimates(rats_a, rats_b)
+        k = self.k * hlp.interpolate(task_diff, *DifficultyManager._DIFF_RANGE, 0.0, 1.0)
+        drs = k * (outcomes - exp)
+        instrumentation.count("match evaluations", np.size(drs) if matches is None else int(np.count_nonzero(matches)))
+        if instrumentation.debug_sme:
+            arrays = np.broadcast_arrays(rats_a, rats_b, outcomes, exp, drs)
+            for a, b, o, e, dr in zip(*(x[matches] if matches is not None else x.ravel() for x in arrays)):
+                print(f"Match (rank={a:>8.2f}) {o:.1f} vs (rank={b:>8.2f}): exp={e:.2f} k={k:.2f} dr={dr:>10.3f}")
+        return drs
+
+    def _get_estimates(self, rats_a:np.ndarray, rats_b:np.ndarray) -> np.ndarray:
+        return 1 / ( 1 + 10**(-(rats_a-rats_b)/self.sigma) )
+
 #Margin Of Victory:
 # http://www2.stat-athens.aueb.gr/~jbn/conferences/MathSport_presentations/plenary%20talks/P3%20-%20Kovalchik%20-%20Extensions%20of%20the%20Elo%20Rating%20System%20for%20Margin%20of%20Victory.pdf
 # https://rdrr.io/github/GIGTennis/elomov/src/R/linear.R
@@ -47,6 +66,12 @@ class MOV(ELO):
     def _get_estimate(self, rat_a:float, rat_b:float):
         return (float(rat_a)-float(rat_b)) / self.sigma
 
+    def get_outcomes(self, scores_a:np.ndarray, scores_b:np.ndarray) -> np.ndarray:
+        return scores_b - scores_a
+
+    def _get_estimates(self, rats_a:np.ndarray, rats_b:np.ndarray) -> np.ndarray:
+        return (rats_a-rats_b) / self.sigma
+
 
 
 #Simple Multiplayer ELO: http://www.tckerrigan.com/Misc/Multiplayer_Elo/
@@ -58,54 +83,62 @@ class SME(RatingSystemLogic):
         self.elo_mgr = elo_mgr
         self.diff_mgr = difficulty_mgr
 
-    def _calc_updated_ranks_impl(self, curr_ranks: List[Rating], task_info: TaskInfo, leaderboard: pd.DataFrame) -> List[Rating]:
-        scores = leaderboard["scores"]
-        task_diff = self.diff_mgr.get_task_difficulty(task_info, leaderboard)
-        deltas = self._get_rating_deltas(task_diff, scores, curr_ranks)
-        return [EloRating(curr + dr) for curr, dr in zip(curr_ranks, deltas)]
-
-    def _get_rating_deltas(self, task_diff:float, scores:List[float], curr_ranks:List[Rating]) -> List[float]:
-        deltas = [0.0 for _ in scores]
-        for i in range(len(scores)-1):
-            outcome = self.elo_mgr.get_outcome(scores[i], scores[i+1])
-            dr = self.elo_mgr.get_dr(curr_ranks[i], curr_ranks[i+1], task_diff, outcome)
-            deltas[i]   += dr
-            deltas[i+1] -= dr
+    def precompute(self, data_list) -> None:
+        self.diff_mgr.precompute(data_list)
+
+    def _calc_updated_ranks_impl(self, curr_ranks: np.ndarray, task_info: TaskInfo, record: TaskRecord) -> np.ndarray:
+        task_diff = self.diff_mgr.get_task_difficulty(task_info, record)
+        return curr_ranks + self._get_rating_deltas(task_diff, record.scores, curr_ranks)
+
+    def _get_rating_deltas(self, task_diff:float, scores:np.ndarray, curr_ranks:np.ndarray) -> np.ndarray:
+        drs = self.elo_mgr.get_drs(curr_ranks[:-1], curr_ranks[1:], task_diff, self.elo_mgr.get_outcomes(scores[:-1], scores[1:]))
+        deltas = np.zeros(len(scores))
+        deltas[:-1] += drs
+        deltas[1:]  -= drs
         return deltas
 
 #SME Everyone vs Everyone: matches all possible pairs instead of directly up and down
 class SME_EvE(SME):
-    def __init__(self, elo_mgr: ELO):
+    def __init__(self, elo_mgr: ELO, difficulty_mgr:DifficultyManager=DifficultyManager()):
         elo_mgr.k /= 19
-        super().__init__(elo_mgr)
-
-    def _get_rating_deltas(self, task_diff: float, scores: List[float], curr_ranks: List[Rating]) -> List[float]:
-        deltas = [0.0 for _ in scores]
-        for i in range(len(scores)-1):
-            for j in range(i+1, len(scores)):
-                outcome = self.elo_mgr.get_outcome(scores[i], scores[j])
-                dr = self.elo_mgr.get_dr(curr_ranks[i], curr_ranks[j], task_diff, outcome)
-                deltas[i] += dr
-                deltas[j] -= dr
-        return deltas
+        super().__init__(elo_mgr, difficulty_mgr)
+
+    def _get_rating_deltas(self, task_diff: float, scores: np.ndarray, curr_ranks: np.ndarray) -> np.ndarray:
+        n = len(scores)
+        above = np.triu(np.ones((n, n), dtype=bool), 1)
+        drs = self.elo_mgr.get_drs(curr_ranks[:,None], curr_ranks[None,:], task_diff, self.elo_mgr.get_outcomes(scores[:,None], scores[None,:]), above)
+        #row k holds -dr of the matches against everyone above k, then +dr against everyone below,
+        #cumsum adds them up sequentially in the same order a pairwise loop would
+        signed = np.where(above, drs, 0.0) - np.where(above.T, drs.T, 0.0)
+        return np.cumsum(signed, axis=1)[:,-1] if n else np.zeros(0)
+
+    def calc_joined_ranks(self, curr_ranks: np.ndarray, task_info: TaskInfo, record: TaskRecord, joined: np.ndarray) -> np.ndarray:
+        """only the newcomers' matches, against everyone in the field; a match's dr is antisymmetric,
+        so newcomer row a, column b is a's gain and b's loss"""
+        task_diff = self.diff_mgr.get_task_difficulty(task_info, record)
+        new = np.flatnonzero(joined)
+        once = ~joined[None,:] | (np.arange(len(joined))[None,:] > new[:,None])   #a pair of newcomers meets in both rows
+        drs = self.elo_mgr.get_drs(curr_ranks[new,None], curr_ranks[None,:], task_diff, self.elo_mgr.get_outcomes(record.scores[new,None], record.scores[None,:]), once)
+        drs[np.arange(len(new)), new] = 0.0
+        deltas = -np.where(joined[None,:], 0.0, drs).sum(axis=0)
+        deltas[new] = drs.sum(axis=1)
+        return curr_ranks + deltas
 
 class SME_avgn(SME):
-    def _get_rating_deltas(self, task_diff: float, scores: List[float], curr_ranks: List[Rating]) -> List[float]:
-        deltas = [0.0 for _ in scores]
-        for i in range(len(scores)):
-            if i > 0:
-                outcome = self.elo_mgr.get_outcome(scores[i], statistics.mean(scores[:i]))
-                deltas[i] += self.elo_mgr.get_dr(curr_ranks[i], statistics.mean(curr_ranks[:i]), task_diff, outcome)
-            if i < len(scores)-1:
-                outcome = self.elo_mgr.get_outcome(scores[i], statistics.mean(scores[i+1:]))
-                deltas[i] += self.elo_mgr.get_dr(curr_ranks[i], statistics.mean(curr_ranks[i+1:]), task_diff, outcome)
+    def _get_rating_deltas(self, task_diff: float, scores: np.ndarray, curr_ranks: np.ndarray) -> np.ndarray:
+        def means_before(v):
+            return np.cumsum(v)[:-1] / np.arange(1, len(v))
+        def means_after(v):
+            return np.cumsum(v[::-1])[::-1][1:] / np.arange(len(v)-1, 0, -1)
+
+        deltas = np.zeros(len(scores))
+        outcomes = self.elo_mgr.get_outcomes(scores[1:], means_before(scores))
+        deltas[1:] += self.elo_mgr.get_drs(curr_ranks[1:], means_before(curr_ranks), task_diff, outcomes)
+        outcomes = self.elo_mgr.get_outcomes(scores[:-1], means_after(scores))
+        deltas[:-1] += self.elo_mgr.get_drs(curr_ranks[:-1], means_after(curr_ranks), task_diff, outcomes)
         return deltas
 
 class SME_avg2(SME):
-    def _get_rating_deltas(self, task_diff: float, scores: List[float], curr_ranks: List[Rating]) -> List[float]:
-        deltas = [0.0 for _ in scores]
-        for i in range(len(scores)):
-            outcome = hlp.interpolate_inverse(scores[i], *SCORE_RANGE, 0.0, 1.0)
-            deltas[i] = self.elo_mgr.get_dr(curr_ranks[i], statistics.mean(curr_ranks), task_diff, outcome)
-        return deltas
-
+    def _get_rating_deltas(self, task_diff: float, scores: np.ndarray, curr_ranks: np.ndarray) -> np.ndarray:
+        outcomes = 1.0 - (scores-SCORE_RANGE[0])/(SCORE_RANGE[1]-SCORE_RANGE[0])
+        return self.elo_mgr.get_drs(curr_ranks, curr_ranks.mean(), task_diff, outcomes)
@@ -1,42 +1,90 @@
 from rating_system import RatingSystem, ScoringManager
 import pandas as pd
-from dataclasses import dataclass
 from collections import defaultdict
 from typing import List
+from dataclasses import dataclass
 from globals import *
-import database
+import numpy as np, hashlib
+import database, players, instrumentation
 
+#player statistics from all leaderboards as one long table, one row per (task, player), grouped by player id.
+#An aggregate is f(rows, player, n): rows the long columns, player the group of each row, n the number of groups.
 class Statistics:
-    @dataclass
-    class SRow:
-        tasks: int = 0
-        gold: int = 0
-        silver: int = 0
-        bronze: int = 0
-        avg_rating: float = 0.0
-        def add_ranked_task(self, rank):
-            self.tasks += 1
-            self.avg_rating = (self.avg_rating*(self.tasks-1) + rank) / self.tasks
-            rank = int(rank + 0.5)
-            if rank == 1: self.gold += 1
-            if rank == 2: self.silver += 1
-            if rank == 3: self.bronze += 1
-
-    def collect(data) -> pd.DataFrame:
-        stats = defaultdict(Statistics.SRow)
-        for _, leaderboard in data:
-            interp_ranks = ScoringManager().get_scores(leaderboard)
-            for name, rank in zip(leaderboard["name"], interp_ranks):
-                stats[name].add_ranked_task(rank)
-        return pd.DataFrame.from_dict(stats, orient='index', columns=["tasks", "gold", "silver", "bronze", "avg_rating"])
-
-def _prepare_data(task_ids: List[int]):
-    data = []
-    for id in task_ids:
-        task_info = TaskInfo(id, Lang.cpp, database.get_accepted_submissions(id))
-        leaderboard = database.get_task_leaderboard(task_info)
-        data.append((task_info, leaderboard))
-    return data
+    def rows(data) -> dict:
+        lengths = np.array([len(record.player_ids) for _, record in data], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        code_len = np.concatenate([record.code_len for _, record in data]) if data else np.zeros(0, dtype=np.int64)
+        return {
+            "player_id": np.concatenate([record.player_ids for _, record in data]) if data else np.zeros(0, dtype=np.int64),
+            "score":     ScoringManager().get_scores_batch(offsets, code_len),
+            "code_len":  code_len,
+            "task":      np.repeat(np.arange(len(data)), lengths),
+        }
+
+    def collect(data, columns=None) -> pd.DataFrame:
+        with instrumentation.span("aggregation"):
+            rows = Statistics.rows(data)
+            ids, player = np.unique(rows["player_id"], return_inverse=True)
+            columns = columns or Statistics.COLUMNS
+            return pd.DataFrame({c: Statistics.AGGREGATES[c](rows, player, len(ids)) for c in columns}, index=players.names()[ids])
+
+    def _count(rows, player, n):
+        return np.bincount(player, minlength=n)
+
+    def _places(place):
+        return lambda rows, player, n: np.bincount(player, weights=np.floor(rows["score"]+0.5) == place, minlength=n).astype(np.int64)
+
+    def _mean_score(rows, player, n):
+        return np.bincount(player, weights=rows["score"], minlength=n) / np.maximum(np.bincount(player, minlength=n), 1)
+
+    def _median_score(rows, player, n):
+        return _group_median(rows["score"], player, n)
+
+    def _best_score(rows, player, n):
+        best = np.full(n, np.inf)
+        np.minimum.at(best, player, rows["score"])
+        return best
+
+    def _breaking_100(rows, player, n):
+        """solutions under 100 characters on tasks whose median solution is 100 or longer"""
+        task_median = _group_median(rows["code_len"], rows["task"], rows["task"].max()+1 if len(rows["task"]) else 0)
+        breaking = (rows["code_len"] < 100) & (task_median[rows["task"]] >= 100)
+        return np.bincount(player, weights=breaking, minlength=n).astype(np.int64)
+
+    AGGREGATES = {
+        "tasks":        _count,
+        "gold":         _places(1),
+        "silver":       _places(2),
+        "bronze":       _places(3),
+        "avg_rating":   _mean_score,
+        "median_rank":  _median_score,
+        "best_score":   _best_score,
+        "breaking_100": _breaking_100,
+    }
+    COLUMNS = ["tasks", "gold", "silver", "bronze", "avg_rating"]  #what the global leaderboard shows
+
+def _group_median(values, group, n) -> np.ndarray:
+    order = np.lexsort((values, group))
+    values = np.asarray(values, dtype=np.float64)[order]
+    counts = np.bincount(group, minlength=n)
+    starts = np.cumsum(counts) - counts
+    lo, hi = starts + (counts-1)//2, starts + counts//2
+    return np.where(counts > 0, (values[np.minimum(lo, len(values)-1)] + values[np.minimum(hi, len(values)-1)]) / 2, np.nan) if len(values) else np.full(n, np.nan)
+
+def _prepare_data(task_ids: List[int], langs=(Lang.cpp,)):
+    return [x for lang in langs for x in database.get_rating_data(task_ids, lang)]
+
+def _language_systems(rat_systems: List[RatingSystem], data):
+    """(rating system, language) pairs to rate: each system over every language combined (language None),
+    plus a copy per language if there are several. Player ids are shared, so one player gets one row."""
+    pairs = [(rat_sys, None) for rat_sys in rat_systems]
+    langs = sorted({task_info.lang for task_info, _ in data}, key=lambda l: l.value)
+    if len(langs) > 1:
+        pairs += [(RatingSystem(r.logic, r.scoring_mgr, f"{r.description} {lang.name}"), lang) for r in rat_systems for lang in langs]
+    return pairs
+
+def _in_language(lang, data):
+    return data if lang is None else [(t, r) for t, r in data if t.lang == lang]
 
 def _construct_leaderboard(dataframes: List[pd.DataFrame], columns_to_sort_by:List[str]) -> pd.DataFrame:
     global_leaderboard = pd.concat(dataframes, axis=1)
@@ -49,17 +97,170 @@ def _construct_leaderboard(dataframes: List[pd.DataFrame], columns_to_sort_by:Li
 
 
 
-def calc(task_ids: List[int], rat_systems: List[RatingSystem], runs) -> pd.DataFrame:
-    data = _prepare_data(task_ids)
+REPLAY_WINDOW = 50  #changed tasks an order-dependent system may absorb before it is rebuilt from scratch
+
+@dataclass
+class LeaderboardOptions:
+    runs:           int = 100           #shuffled passes averaged by order-dependent systems
+    workers:        int = None          #processes running them
+    tolerance:      float = None        #stop the runs early, see RatingSystem.rate_with_errors
+    top:            int = None
+    chronological:  bool = False        #replay order-dependent systems in submission order instead, see replay.py
+    langs:          tuple = (Lang.cpp,) #several get per-language columns next to the combined ones
+    incremental:    bool = False        #only rate tasks changed since the last construction, see calc_incremental
+    replay_window:  int = REPLAY_WINDOW
 
+def calc(task_ids: List[int], rat_systems: List[RatingSystem], options=LeaderboardOptions()) -> pd.DataFrame:
+    return calc_from_data(_prepare_data(task_ids, options.langs), rat_systems, options)
+
+#averaged systems get a "<system> ±" column with their 95% confidence interval
+def calc_from_data(data, rat_systems: List[RatingSystem], options=LeaderboardOptions()) -> pd.DataFrame:
     dataframes = []
-    for rat_sys in rat_systems:
-        rating_dict = rat_sys.rate_multiple_runs(data, runs)
-        dataframes.append(pd.DataFrame.from_dict(rating_dict, orient='index', columns=[rat_sys.description], dtype=float))
+    for rat_sys, lang in _language_systems(rat_systems, data):
+        dataframes.append(_columns(rat_sys, *_rate(rat_sys, _in_language(lang, data), options)))
     
     dataframes.append(Statistics.collect(data))
     
     return _construct_leaderboard(dataframes, [r.description for r in rat_systems])
 
 
+def calc_incremental(task_ids: List[int], rat_systems: List[RatingSystem], state=None, options=LeaderboardOptions()):
+    """(leaderboard, new state); only tasks that changed since state are rated, state=None rebuilds everything.
+    Order-independent systems (skill points) come out exactly as from calc. Order-dependent ones (Elo) fold
+    the changed tasks over their stored averages (see _fold_order_dependent), which is an approximation, so
+    after replay_window folded tasks they are rerun over all data. Chronological ones are replayed in full
+    whenever a task changed."""
+    data = _prepare_data(task_ids, options.langs)
+    fingerprints = {str(t): _fingerprint(t, r) for t, r in data}
+    if state is None or "fields" not in state:  #older states can't tell new tasks from grown ones
+        state = {"tasks": {}, "systems": {}, "fields": {}}
+    changed = [(t, r) for t, r in data if state["tasks"].get(str(t)) != fingerprints[str(t)]]
+    removed = [key for key in state["tasks"] if key not in fingerprints]
+    print(f"global leaderboard: {len(changed)} changed and {len(removed)} removed of {len(data)} tasks")
+
+    dataframes = []
+    for rat_sys, lang in _language_systems(rat_systems, data):
+        sys_state = state["systems"].get(rat_sys.description)
+        if sys_state is not None and sys_state["signature"] != _signature(rat_sys, options.chronological):
+            sys_state = None
+        lang_data, lang_changed = _in_language(lang, data), _in_language(lang, changed)
+        lang_removed = [key for key in removed if lang is None or key.rstrip("0123456789") == lang.name]
+        if rat_sys.logic.ORDER_INDEPENDENT:
+            sys_state = _fold_order_independent(rat_sys, sys_state, lang_data if sys_state is None else lang_changed, lang_removed)
+        elif _replays(rat_sys, options.chronological):
+            if sys_state is None or lang_changed or lang_removed:
+                ratings, ci = _rate(rat_sys, lang_data, options)
+                sys_state = {"signature": _signature(rat_sys, True), "ratings": ratings, "ci": ci, "drift": 0}
+        else:
+            sys_state = _fold_order_dependent(rat_sys, sys_state, lang_data, lang_changed, lang_removed, state["fields"], options)
+        state["systems"][rat_sys.description] = sys_state
+        dataframes.append(_columns(rat_sys, sys_state["ratings"], sys_state.get("ci")))
+
+    state["tasks"] = fingerprints
+    state["fields"] = {str(t): r.names for t, r in data}
+    for key in ("stats", "task_scores"):    #kept by states written before statistics were recomputed in one pass
+        state.pop(key, None)
+    dataframes.append(Statistics.collect(data))
+
+    return _construct_leaderboard(dataframes, [r.description for r in rat_systems]), state
+
+def _fingerprint(task_info, record) -> str:
+    h = hashlib.sha1(str(task_info.accepted_submissions).encode())
+    h.update("\n".join(record.names).encode())
+    h.update(np.ascontiguousarray(record.code_len, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+def _signature(rat_sys: RatingSystem, chronological=False) -> str:
+    """every parameter the stored ratings depend on, so changing one rebuilds them"""
+    signature = repr((_parameters(rat_sys.logic), _parameters(rat_sys.scoring_mgr)))
+    return signature + "/chronological" if _replays(rat_sys, chronological) else signature
+
+def _replays(rat_sys: RatingSystem, chronological) -> bool:
+    """chronological mode applies to order-dependent systems with plain float ratings"""
+    return chronological and not rat_sys.logic.ORDER_INDEPENDENT and rat_sys.logic.new_ratings(0).dtype.names is None
+
+def _parameters(obj):
+    """managers by their task cache keys, other objects (a logic, its ELO) by class and attributes"""
+    if isinstance(obj, type):
+        return obj.__name__
+    if hasattr(obj, "_params"):
+        return obj._params()
+    if hasattr(obj, "__dict__"):
+        return (type(obj).__name__,) + tuple((name, _parameters(value)) for name, value in sorted(vars(obj).items()))
+    return obj
+
+def _rate(rat_sys: RatingSystem, data, options) -> tuple:
+    """(ratings, their confidence intervals) by name; intervals are None where the ratings don't vary between runs"""
+    if _replays(rat_sys, options.chronological):
+        import replay
+        return replay.replay(rat_sys, data).rankings, None
+    errors = rat_sys.rate_with_errors(data, options.runs, options.workers, tolerance=options.tolerance, top=options.top)
+    return errors["rating"].to_dict(), None if rat_sys.logic.ORDER_INDEPENDENT else errors["ci95"].to_dict()
+
+def _columns(rat_sys: RatingSystem, ratings:dict, ci:dict) -> pd.DataFrame:
+    """the ratings, and their confidence intervals unless there are none (single runs have no spread)"""
+    frame = pd.DataFrame.from_dict(ratings, orient='index', columns=[rat_sys.description], dtype=float)
+    if ci is not None and not all(np.isnan(v) for v in ci.values()):
+        frame[rat_sys.description + " ±"] = pd.Series(ci, dtype=float)
+    return frame
+
+def _fold_order_independent(rat_sys: RatingSystem, sys_state, data, removed_keys):
+    """each task adds a fixed delta per player, so changed tasks are swapped out exactly"""
+    contributions = {} if sys_state is None else sys_state["contributions"]
+    for key in removed_keys:
+        contributions.pop(key, None)
+    rat_sys.precompute(data)
+    for task_info, record in data:
+        record = record._replace(scores=rat_sys.scoring_mgr.get_task_scores(task_info, record))
+        start = rat_sys.logic.new_ratings(len(record.player_ids))
+        deltas = rat_sys.logic.to_float(rat_sys.logic.calc_updated_ranks(start, task_info, record)) - rat_sys.logic.to_float(start)
+        contributions[str(task_info)] = (record.names, deltas)
+
+    totals = defaultdict(lambda: float(rat_sys.logic.to_float(rat_sys.logic.new_ratings(1))[0]))
+    for names, deltas in contributions.values():
+        for name, delta in zip(names, deltas):
+            totals[name] += delta
+    return {"signature": _signature(rat_sys), "ratings": dict(totals), "contributions": contributions, "drift": 0}
+
+def _fold_order_dependent(rat_sys: RatingSystem, sys_state, data, changed, removed_keys, fields, options):
+    """brand-new tasks are shuffled over the stored averages; tasks that gained players only play the newcomers'
+    matches (see calc_joined_ranks), their old ones are already in the averages. Logics that can't do that,
+    and removed tasks, whose matches can't be taken out again, rebuild from scratch. Folded players have no
+    confidence interval until the next rebuild: the fold doesn't rerun the order their averages came from."""
+    drift = len(changed) + len(removed_keys)
+    scalar = rat_sys.logic.new_ratings(0).dtype.names is None
+    if sys_state is None or not scalar or removed_keys or sys_state["drift"] + drift > options.replay_window:
+        return _rebuild(rat_sys, data, options)
+    ratings = dict(sys_state["ratings"])
+    grown = [(t, r) for t, r in changed if str(t) in fields]
+    rat_sys.precompute(grown)
+    default = float(rat_sys.logic.to_float(rat_sys.logic.new_ratings(1))[0])
+    for task_info, record in grown:
+        joined = ~np.isin(record.player_ids, players.intern(list(fields[str(task_info)])))
+        if not joined.any():
+            continue
+        curr = np.array([ratings.get(name, default) for name in record.names], dtype=np.float64)
+        record = record._replace(scores=rat_sys.scoring_mgr.get_task_scores(task_info, record))
+        new_ranks = rat_sys.logic.calc_joined_ranks(curr, task_info, record, joined)
+        if new_ranks is None:
+            return _rebuild(rat_sys, data, options)
+        ratings.update(zip(record.names, rat_sys.logic.to_float(new_ranks)))
+    new = [(t, r) for t, r in changed if str(t) not in fields]
+    if new:
+        rat_sys.set_initial_ratings(ratings)
+        try:
+            ratings.update(rat_sys.rate_multiple_runs(new, options.runs, options.workers, tolerance=options.tolerance, top=options.top))
+        finally:
+            rat_sys.set_initial_ratings(None)
+    folded = set().union(*(record.names for _, record in changed))
+    sys_state["ratings"] = ratings
+    sys_state["ci"] = {name: ci for name, ci in sys_state["ci"].items() if name not in folded}
+    sys_state["drift"] += drift
+    return sys_state
+
+def _rebuild(rat_sys: RatingSystem, data, options):
+    ratings, ci = _rate(rat_sys, data, options)
+    return {"signature": _signature(rat_sys), "ratings": ratings, "ci": ci, "drift": 0}
+
+
 #todo: add breaking 100 bonus
\ No newline at end of file
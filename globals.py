@@ -12,8 +12,3 @@ class TaskInfo(NamedTuple):
     def __repr__(self):
         return f"{self.lang.name}{self.id}"
 
-
-# settings
-PRINT_DIFF          = False
-PRINT_LEADERBOARD   = False
-PRINT_SME           = False
\ No newline at end of file
@@ -1,4 +1,4 @@
-import numpy as np, matplotlib.pyplot as plt
+import numpy as np
 from math import isclose
 
 def pretty(list_of_floats, precision=3) -> str:
@@ -15,6 +15,7 @@ def interpolate_inverse(x:float, min_orig:float, max_orig:float, min_target:floa
     return max_target - (x-min_orig)/(max_orig-min_orig)*(max_target-min_target)
 
 def plot(x_list, f) -> None:
+    import matplotlib.pyplot as plt
     x_axis = np.linspace(min(x_list)*.9, max(x_list)*1.1)
     plt.plot(
         x_axis, [f(x) for x in x_axis],
@@ -0,0 +1,159 @@
+import json, sys, threading, time
+from collections import Counter
+
+#named spans and counters for the hot paths, plus the debug printouts. Everything is off until enable():
+#span() then hands out one shared no-op object and count() returns at its first check, and inner loops
+#test the debug_* flags directly. Worker processes are enabled with worker_settings() and send what they
+#collected back with collect(), which the parent adds to its own with merge().
+
+debug_diff = False          #task difficulty breakdowns
+debug_leaderboard = False   #every rated and evaluated leaderboard
+debug_sme = False           #every Elo match
+
+_enabled = False
+_spans = {}                 #name -> [calls, seconds]
+_counters = Counter()
+_lock = threading.Lock()
+_profiler = None
+_sampler = None
+_started = None
+
+def enable(profile=False, sample_interval=None, debug=()) -> None:
+    """starts collecting; profile=True runs cProfile, sample_interval (seconds) samples the main thread's
+    stack instead, which costs far less; debug names the printouts to switch on: diff, leaderboard, sme"""
+    global _enabled, _profiler, _sampler, _started, debug_diff, debug_leaderboard, debug_sme
+    reset()
+    _enabled, _started = True, time.perf_counter()
+    debug_diff, debug_leaderboard, debug_sme = "diff" in debug, "leaderboard" in debug, "sme" in debug
+    if profile:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if sample_interval:
+        _sampler = _Sampler(sample_interval)
+
+def disable() -> None:
+    global _enabled, _profiler, _sampler, debug_diff, debug_leaderboard, debug_sme
+    _enabled = debug_diff = debug_leaderboard = debug_sme = False
+    if _profiler is not None:
+        _profiler.disable()
+    if _sampler is not None:
+        _sampler.stop()
+
+def reset() -> None:
+    global _profiler, _sampler
+    _spans.clear()
+    _counters.clear()
+    _profiler = _sampler = None
+
+def worker_settings():
+    """what a worker process passes to enable(debug=...) to collect like this one, None if disabled"""
+    if not _enabled:
+        return None
+    return tuple(name for name, on in (("diff", debug_diff), ("leaderboard", debug_leaderboard), ("sme", debug_sme)) if on)
+
+def collect() -> tuple:
+    """(spans, counters) collected since the last collect(), for merge() in another process"""
+    with _lock:
+        collected = (dict(_spans), dict(_counters))
+        _spans.clear()
+        _counters.clear()
+    return collected
+
+def merge(collected) -> None:
+    spans, counters = collected
+    with _lock:
+        for name, (calls, seconds) in spans.items():
+            totals = _spans.setdefault(name, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+        _counters.update(counters)
+
+
+def span(name):
+    """with span("parse"): ... adds the block's wall time to name"""
+    return _Span(name) if _enabled else _NO_SPAN
+
+def count(name, n=1) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += n
+
+
+class _Span:
+    __slots__ = ("name", "start")
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            totals = _spans.setdefault(self.name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+_NO_SPAN = _NoSpan()
+
+class _Sampler:
+    """counts the innermost project-level function of the main thread every interval seconds"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._main = threading.main_thread().ident
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._main)
+            while frame is not None and "site-packages" in frame.f_code.co_filename:
+                frame = frame.f_back
+            if frame is not None:
+                self.samples[f"{frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_code.co_name}"] += 1
+
+    def stop(self):
+        self._stop.set()
+
+
+def report(top=20) -> dict:
+    """what was collected since enable(), as plain data"""
+    result = {
+        "wall_seconds": time.perf_counter() - _started if _started is not None else 0.0,
+        "spans": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in sorted(_spans.items(), key=lambda x: -x[1][1])},
+        "counters": dict(_counters),
+    }
+    if _profiler is not None:
+        import pstats
+        stats = pstats.Stats(_profiler).stats
+        slowest = sorted(stats.items(), key=lambda x: -x[1][3])[:top]
+        result["profile"] = [{"function": f"{file.rsplit('/', 1)[-1]}:{line}({name})", "calls": nc, "own_seconds": tt, "cumulative_seconds": ct}
+                             for (file, line, name), (_, nc, tt, ct, _) in slowest]
+    if _sampler is not None:
+        result["samples"] = dict(_sampler.samples.most_common(top))
+    return result
+
+def save_report(filename, top=20) -> None:
+    with open(filename, 'w') as f:
+        json.dump(report(top), f, indent=2)
+
+def print_report(top=20) -> None:
+    r = report(top)
+    print(f"\n{'span':<28} {'calls':>8} {'seconds':>10}   ({r['wall_seconds']:.2f}s wall)")
+    for name, s in r["spans"].items():
+        print(f"{name:<28} {s['calls']:>8} {s['seconds']:>10.3f}")
+    for name, n in sorted(r["counters"].items()):
+        print(f"{name:<28} {n:>19,}")
+    for entry in r.get("profile", []):
+        print(f"{entry['cumulative_seconds']:>9.3f}s {entry['own_seconds']:>9.3f}s {entry['calls']:>9}  {entry['function']}")
+    for function, n in r.get("samples", {}).items():
+        print(f"{n:>8} samples  {function}")
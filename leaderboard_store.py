@@ -0,0 +1,157 @@
+import numpy as np, pandas as pd, os, shutil, uuid
+from durable import atomic_write, fsync_dir
+
+#one row per leaderboard entry, rows of a task are contiguous and described by keys/offsets
+_COLUMN_DTYPES = {
+    "task_id":  np.int32,
+    "lang":     np.int16,   #index into langs table
+    "rank":     np.int32,
+    "name_id":  np.int32,   #index into names table
+    "runtime":  np.float64,
+    "memory":   np.float64,
+    "code_len": np.int32,
+    "date":     "datetime64[s]",
+}
+_TABLES = ["names", "langs", "keys", "offsets"]
+_CURRENT = "CURRENT"
+
+
+class LeaderboardStore:
+    def __init__(self, path):
+        self.path = path
+        self._pending = {}
+        self._open()
+
+    def __contains__(self, key) -> bool:
+        if key in self._pending:
+            return self._pending[key] is not None
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self.task_keys())
+
+    def __getitem__(self, key) -> pd.DataFrame:
+        if key in self._pending:
+            if self._pending[key] is None:
+                raise KeyError(key)
+            return self._pending[key].copy()
+        return self._frame(self._index[key])
+
+    def __setitem__(self, key, leaderboard:pd.DataFrame):
+        self._pending[key] = leaderboard
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._pending[key] = None
+
+    def task_keys(self):
+        keys = [k for k in self._index if k not in self._pending]
+        return keys + [k for k, v in self._pending.items() if v is not None]
+
+    def task_rows(self, key) -> slice:
+        i = self._index[key]
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    def clear(self) -> None:
+        self._pending = dict.fromkeys(self._index)
+
+    def commit(self) -> list:
+        """writes staged changes as a new generation, returns the keys that were written or deleted"""
+        if not self._pending:
+            return []
+        names, langs = list(self.names), list(self.langs)
+        name_ids = {n: i for i, n in enumerate(names)}
+        lang_ids = {l: i for i, l in enumerate(langs)}
+        def intern(values, table, ids):
+            for v in values:
+                if v not in ids:
+                    ids[v] = len(table)
+                    table.append(v)
+            return [ids[v] for v in values]
+
+        kept = [i for i, k in enumerate(self.keys) if k not in self._pending]
+        keep_rows = np.repeat(np.isin(np.arange(len(self.keys)), kept), np.diff(self.offsets))
+        chunks = [{col: self.columns[col][keep_rows] for col in _COLUMN_DTYPES}]
+        keys = [str(self.keys[i]) for i in kept]
+        lengths = list(np.diff(self.offsets)[kept])
+        for key, leaderboard in self._pending.items():
+            if leaderboard is None:
+                continue
+            n = len(leaderboard.index)
+            chunks.append({
+                "task_id":  np.full(n, _task_id(key)),
+                "lang":     intern([str(l) for l in leaderboard["lang"]], langs, lang_ids),
+                "rank":     leaderboard["rank"].to_numpy(),
+                "name_id":  intern(list(leaderboard["name"]), names, name_ids),
+                "runtime":  pd.to_numeric(leaderboard["runtime"], errors="coerce").to_numpy(),
+                "memory":   pd.to_numeric(leaderboard["memory"], errors="coerce").to_numpy(),
+                "code_len": leaderboard["code_len"].to_numpy(),
+                "date":     pd.to_datetime(leaderboard["date"], dayfirst=True, errors="coerce").to_numpy(),
+            })
+            keys.append(key)
+            lengths.append(n)
+
+        arrays = {col: np.concatenate([np.asarray(c[col]).astype(dtype) for c in chunks]) for col, dtype in _COLUMN_DTYPES.items()}
+        arrays["names"] = np.array(names, dtype=str)
+        arrays["langs"] = np.array(langs, dtype=str)
+        arrays["keys"] = np.array(keys, dtype=str)
+        arrays["offsets"] = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        self._write_generation(arrays)
+        changed, self._pending = list(self._pending), {}
+        return changed
+
+
+
+    def _open(self):
+        generation = self.generation = self._current_generation()
+        if generation is None:
+            self.columns = {col: np.empty(0, dtype) for col, dtype in _COLUMN_DTYPES.items()}
+            self.names = self.langs = self.keys = np.empty(0, str)
+            self.offsets = np.zeros(1, np.int64)
+        else:
+            load = lambda name: np.load(os.path.join(self.path, generation, name+".npy"), mmap_mode='r')
+            self.columns = {col: load(col) for col in _COLUMN_DTYPES}
+            self.names, self.langs, self.keys, self.offsets = (load(t) for t in _TABLES)
+        self._index = {str(k): i for i, k in enumerate(self.keys)}
+
+    def _current_generation(self):
+        try:
+            with open(os.path.join(self.path, _CURRENT)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _write_generation(self, arrays):
+        """every file of the new generation is on disk before CURRENT points at it;
+        afterwards the previous generation and any left behind by an interrupted commit are removed"""
+        generation = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.path, generation))
+        for name, arr in arrays.items():
+            with open(os.path.join(self.path, generation, name+".npy"), 'wb') as f:
+                np.save(f, arr)
+                f.flush()
+                os.fsync(f.fileno())
+        fsync_dir(os.path.join(self.path, generation))
+        atomic_write(os.path.join(self.path, _CURRENT), lambda f: f.write(generation.encode()))
+        self._open()
+        for entry in os.listdir(self.path):
+            if entry != generation and os.path.isdir(os.path.join(self.path, entry)):
+                shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+
+    def _frame(self, i) -> pd.DataFrame:
+        rows = slice(self.offsets[i], self.offsets[i+1])
+        col = lambda c: self.columns[c][rows]
+        return pd.DataFrame({
+            "rank":     col("rank"),
+            "date":     col("date"),
+            "name":     self.names[col("name_id")].astype(object),
+            "lang":     self.langs[col("lang")].astype(object),
+            "runtime":  col("runtime"),
+            "memory":   col("memory"),
+            "code_len": col("code_len"),
+        })
+
+
+def _task_id(key) -> int:
+    return int(key.lstrip("abcdefghijklmnopqrstuvwxyz"))
@@ -1,55 +1,67 @@
-import pandas as pd, matplotlib.pyplot as plt
+import pandas as pd, os
 import rating_system_evaluator, database
 from rating_system import *
 from elo import *
 from skill_points import *
+from global_leaderboard import LeaderboardOptions
 
-def fetch_all(lang=Lang.cpp):
-    database.fetch([TaskInfo(id, lang) for id in range(1, 1001)])
+def fetch_all(langs=(Lang.cpp,), workers=database.FETCH_WORKERS):
+    ids = database.get_task_ids(refresh=True)
+    database.fetch([TaskInfo(id, lang) for lang in langs for id in ids], workers)
+
+def refresh_all(langs=(Lang.cpp,), ttl=database.LEADERBOARD_TTL):
+    ids = database.get_task_ids(refresh=True)
+    database.refresh([TaskInfo(id, lang) for lang in langs for id in ids], ttl)
 
 def prepare_local_cache():
     fetch_all()
-    rating_system_evaluator._cache_accuracy_dist_graph(1000000)
+    rating_system_evaluator._cache_accuracy_dist(1000000)
 
-def show_potentials(n=100):
+def show_potentials(n=100, name="Пругло Михаил"):
+    data = database.get_rating_data(database.get_task_ids())
+    DifficultyManager().precompute(data)
+    solved = database.get_player_index().tasks_of(name)
     dmap = {}
-    for id in range(1, 1001):
-        info = TaskInfo(id, Lang.cpp, database.get_accepted_submissions(id))
-        leaderboard = database.get_task_leaderboard(info)
-        sol = "+" if "Пругло Михаил" in list(leaderboard["name"]) else "unsolved"
-        diff = DifficultyManager().get_task_difficulty(info, leaderboard, (0,0))
-        dmap[id] = (diff, sol)
+    for info, record in data:
+        sol = "+" if str(info) in solved else "unsolved"
+        diff = DifficultyManager().get_task_difficulty(info, record)
+        dmap[info.id] = (diff, sol)
     for id, (diff, s) in sorted(dmap.items(), key=lambda x: x[1][0], reverse=True)[:n]:
         print(f"{id:>4} {diff:>10.2f} {s}")
 
 def show_rivalry(name1:str, name2:str, n=200):
     dmap = {}
-    for id in range(1, 1001):
+    for key, postings in database.get_player_index().head_to_head(name1, name2).items():
+        id = postings[0].task_id
         info = TaskInfo(id, Lang.cpp, database.get_accepted_submissions(id))
-        leaderboard = database.get_task_leaderboard(info)
-        if all(name in list(leaderboard["name"]) for name in [name1, name2]):
-            diff = DifficultyManager().get_task_difficulty(info, leaderboard, (0,0))
-            leaderboard["scores"] = ScoringManager().get_scores(leaderboard)
-            head_to_head = leaderboard[leaderboard["name"].isin([name1, name2])]
-            dmap[id] = (diff, head_to_head)
+        if str(info) != key:
+            continue
+        record = database.get_task_record(info)
+        diff = DifficultyManager().get_task_difficulty(info, record)
+        leaderboard = database.get_task_leaderboard(info).assign(scores=ScoringManager().get_task_scores(info, record))
+        head_to_head = leaderboard.iloc[sorted(p.pos for p in postings)]
+        dmap[id] = (diff, head_to_head)
     for id, (diff, hth) in sorted(dmap.items(), key=lambda x: x[1][0], reverse=True)[:n]:
         print(f"{id:>4} {diff:>10.2f}")
         print(hth)
         print()
 
-def show_leaderboard(task_id, lang=Lang.cpp, reload:bool=False):
+def show_leaderboard(task_id, lang=Lang.cpp, reload:bool=False, plot:bool=True):
     if reload==True:
         database.update_one_task(TaskInfo(task_id, lang))
     info = TaskInfo(task_id, lang, database.get_accepted_submissions(task_id))
-    leaderboard = database.get_task_leaderboard(info)
-    scores = leaderboard["scores"] = ScoringManager().get_scores(leaderboard)
-    diff = DifficultyManager().get_task_difficulty(info, leaderboard, verbose=True)
-    pts = leaderboard["pts_earned"] = TMX_const()._calc_rank_deltas(info, leaderboard)
+    record = database.get_task_record(info)
+    scores = ScoringManager().get_task_scores(info, record)
+    diff = DifficultyManager().get_task_difficulty(info, record, verbose=True)
+    pts = TMX_const()._calc_rank_deltas(info, record._replace(scores=scores))
     gl = database.get_global_leaderboard()
     gl.insert(0, "player's global rank", gl.index)
-    leaderboard = leaderboard.merge(gl, on="name")
+    leaderboard = database.get_task_leaderboard(info).assign(scores=scores, pts_earned=pts).merge(gl, on="name")
     print(leaderboard)
-    
+    if not plot:
+        return
+
+    import matplotlib.pyplot as plt
     plt.clf()
     plt.title(f"Task #{task_id}")
     plt.xlabel("score")
@@ -74,19 +86,22 @@ def evaluate():
     ],
     0, 1, tasks=30)
 
-def show_global_leaderboard(recalc:bool=False):
+def show_global_leaderboard(recalc:bool=False, n=50, plot:bool=True, options:LeaderboardOptions=None):
     if recalc==True:
         database.construct_global_leaderboard(rat_systems = [
                 RatingSystem(SME_EvE(MOV()), description="       Elo"),
                 RatingSystem(TMX_const(), description="Skill points"),
             ],
-            runs = 100
+            options = options or LeaderboardOptions(workers=os.cpu_count()),
         )
     gl = database.get_global_leaderboard()#.sort_values("       Elo", ascending=False)
-    print(gl.head(50))
+    print(gl.head(n))
     print("\n\n\n\n")
     #print(database.get_global_leaderboard_row("Пругло Михаил"))
+    if not plot:
+        return
 
+    import matplotlib.pyplot as plt
     plt.clf()
     plot_threshold = 1550
     main_col = "       Elo"
@@ -96,19 +111,40 @@ def show_global_leaderboard(recalc:bool=False):
     plt.hist(plot_data, 100, density=True)
     plt.show()
 
-def update():
-    fetch_all()
-    show_global_leaderboard(recalc=True)
+def update(plot:bool=True, options:LeaderboardOptions=None):
+    options = options or LeaderboardOptions(workers=os.cpu_count(), incremental=True)
+    refresh_all(options.langs)
+    show_global_leaderboard(recalc=True, plot=plot, options=options)
+
+def show_rating_history(names=("Пругло Михаил",), as_of=None, n=50, lang=Lang.cpp, plot:bool=True):
+    """Elo replayed in submission order: the leaderboard as of a date (default the latest) and names' trajectories"""
+    import replay
+    history = replay.replay(RatingSystem(SME_EvE(MOV()), description="Elo"), database.get_rating_data(database.get_task_ids(), lang))
+    date = as_of if as_of is not None else history.dates[-1]
+    print(f"Elo as of {date}:")
+    print(history.as_of(date).head(n).to_string())
+    if not plot or not names:
+        return
 
-def show_worst(n=300):
+    import matplotlib.pyplot as plt
+    plt.clf()
+    plt.title("Elo, replayed in submission order")
+    plt.ylabel("Elo")
+    plt.grid(alpha=0.5, linestyle='dashed')
+    for name, trajectory in history.frame(names).items():
+        plt.step(trajectory.index, trajectory, where="post", label=name)
+    plt.legend()
+    plt.show()
+
+def show_worst(n=300, name="Пругло Михаил"):
     rmap = {}
-    for id in range(1, 1001):
-        info = TaskInfo(id, Lang.cpp, database.get_accepted_submissions(id))
-        leaderboard = database.get_task_leaderboard(info)
-        if "Пругло Михаил" in list(leaderboard["name"]):
-            scores = ScoringManager().get_scores(leaderboard)
-            rank = leaderboard[leaderboard["name"]=="Пругло Михаил"].index[0]
-            rmap[id] = scores[rank] if rank>0 else scores[0]-scores[1]
+    for key, posting in database.get_player_index().tasks_of(name).items():
+        info = TaskInfo(posting.task_id, Lang.cpp, database.get_accepted_submissions(posting.task_id))
+        if str(info) != key:
+            continue
+        scores = ScoringManager().get_task_scores(info, database.get_task_record(info))
+        rank = posting.pos
+        rmap[info.id] = scores[rank] if rank>0 else scores[0]-scores[1]
     for id, rat in sorted(rmap.items(), key=lambda item: item[1], reverse=True)[:n]:
         comment = ""
         if id in [40, 79, 86, 108, 195, 513, 539, 554, 756, 903]: comment = "cheats"
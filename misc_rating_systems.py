@@ -1,34 +1,168 @@
-from rating_system import RatingSystemLogic, Rating
+from rating_system import RatingSystemLogic, Rating, TaskRecord
 from globals import *
-import trueskill, pandas as pd
-from typing import List
+from statistics import NormalDist
+from typing import NamedTuple
+import numpy as np, math
+
+#trueskill is only needed to check TrueSkill against the reference implementation
+def _trueskill():
+    import trueskill
+    return trueskill
+
+class TrueSkillValue(NamedTuple):
+    mu: float
+    sigma: float
 
 class TrueSkillRating(Rating):
     def default_val():
-        return trueskill.Rating()
+        return TrueSkillValue(TrueSkill.MU, TrueSkill.SIGMA)
     def __str__(self) -> str:
         return f"TrueSkill(μ={self.val.mu:>5.2f} σ={self.val.sigma:>5.2f} float:{float(self):>5.2f})"
     def __repr__(self) -> str:
         return f"TrueSkill(μ={self.val.mu:>5.2f} σ={self.val.sigma:>5.2f} float:{float(self):>5.2f})"
     def __float__(self):
-        return trueskill.expose(self.val)
+        return self.val.mu - TrueSkill.MU/TrueSkill.SIGMA*self.val.sigma
 class TrueSkillRatingMean(TrueSkillRating):
     def __float__(self):
         return self.val.mu
 
 
-#broken and not very appropriate: no margin of victory
+#free-for-all TrueSkill on mu/sigma arrays, equal scores are draws; not very appropriate: no margin of victory
 class TrueSkill(RatingSystemLogic):
     RatingT = TrueSkillRating
+    DTYPE = np.dtype([("mu", np.float64), ("sigma", np.float64)])
+    #the trueskill package's defaults
+    MU = 25.0
+    SIGMA = MU/3
+    BETA = SIGMA/2
+    TAU = SIGMA/100
+    DRAW_PROBABILITY = 0.10
+    MIN_DELTA = 0.0001
+
+    def __init__(self, max_iterations=100) -> None:
+        super().__init__()
+        self.max_iterations = max_iterations
+
+    def new_ratings(self, n:int) -> np.ndarray:
+        ratings = np.empty(n, dtype=self.DTYPE)
+        ratings["mu"], ratings["sigma"] = self.MU, self.SIGMA
+        return ratings
+
+    def to_float(self, ratings:np.ndarray) -> np.ndarray:
+        if self.RatingT is TrueSkillRatingMean:
+            return ratings["mu"]
+        return ratings["mu"] - self.MU/self.SIGMA*ratings["sigma"]
+
+    def to_rating(self, val) -> Rating:
+        return self.RatingT(TrueSkillValue(*val))
+
+    def _calc_updated_ranks_impl(self, curr_ranks:np.ndarray, task_info:TaskInfo, record:TaskRecord) -> np.ndarray:
+        scores = record.scores
+        assert(np.all(scores[:-1] <= scores[1:]))  #leaderboard is sorted
+        if len(scores) < 2:
+            return curr_ranks
+        mu, sigma = self._rate_ffa(curr_ranks["mu"], curr_ranks["sigma"], scores[:-1] == scores[1:])
+        new_ranks = np.empty(len(scores), dtype=self.DTYPE)
+        new_ranks["mu"], new_ranks["sigma"] = mu, sigma
+        return new_ranks
+
+    def _rate_ffa(self, mu:np.ndarray, sigma:np.ndarray, tied:np.ndarray) -> tuple:
+        """expectation propagation on the same factor graph as trueskill.rate with one player per team:
+        performances t, differences d[j] = t[j]-t[j+1] truncated by the outcome (tied[j]: j and j+1 drew).
+        Every sweep infers t exactly given the outcome messages (a tridiagonal Gaussian, solved densely
+        as leaderboards are short), then updates all outcome messages at once. Gaussians are kept as
+        natural parameters: pi = 1/var, tau = mean/var."""
+        n = len(mu)
+        draw_margin = NormalDist().inv_cdf((self.DRAW_PROBABILITY+1)/2) * math.sqrt(2) * self.BETA
+        prior_var = sigma**2 + self.TAU**2 + self.BETA**2     #of each performance
+        prior_pi, prior_tau = 1/prior_var, mu/prior_var
+        trunc_pi, trunc_tau = np.zeros(n-1), np.zeros(n-1)    #from the outcome into d[j]
+
+        for _ in range(self.max_iterations):
+            cov, mean = _chain_marginals(prior_pi, prior_tau, trunc_pi, trunc_tau)
+            diag = cov.diagonal()
+            diff_var = diag[:-1] + diag[1:] - 2*cov.diagonal(1)
+            diff_pi = 1/diff_var - trunc_pi                   #d[j] without its outcome message
+            diff_tau = (mean[:-1] - mean[1:])/diff_var - trunc_tau
+
+            sqrt_pi = np.sqrt(diff_pi)
+            v, w = _truncation_vw(diff_tau/sqrt_pi, draw_margin*sqrt_pi, tied)
+            new_pi, new_tau = diff_pi/(1-w), (diff_tau + sqrt_pi*v)/(1-w)
+            delta = np.max(np.maximum(np.abs(new_tau - diff_tau - trunc_tau), np.sqrt(np.abs(new_pi - diff_pi - trunc_pi))))
+            trunc_pi, trunc_tau = new_pi - diff_pi, new_tau - diff_tau
+            if delta <= self.MIN_DELTA:
+                break
+
+        #what the outcome says about each performance, passed back through the performance noise to the skill
+        cov, mean = _chain_marginals(prior_pi, prior_tau, trunc_pi, trunc_tau)
+        perf_pi = 1/np.diag(cov) - prior_pi
+        perf_tau = mean/np.diag(cov) - prior_tau
+        msg_var = 1/perf_pi + self.BETA**2
+        skill_var = sigma**2 + self.TAU**2
+        post_pi = 1/skill_var + 1/msg_var
+        post_tau = mu/skill_var + perf_tau/perf_pi/msg_var
+        return post_tau/post_pi, np.sqrt(1/post_pi)
+
+
+def _chain_marginals(prior_pi, prior_tau, trunc_pi, trunc_tau) -> tuple:
+    """covariance and mean of the performances given their priors and the messages on their differences"""
+    n = len(prior_pi)
+    precision = np.zeros((n, n))
+    precision.flat[::n+1] = prior_pi
+    precision.flat[:n*n-n:n+1] += trunc_pi
+    precision.flat[n+1::n+1] += trunc_pi
+    precision.flat[1:n*n-n:n+1] = precision.flat[n::n+1] = -trunc_pi
+    shift = prior_tau.copy()
+    shift[:-1] += trunc_tau
+    shift[1:] -= trunc_tau
+    cov = np.linalg.inv(precision)
+    return cov, cov @ shift
+
+def _truncation_vw(x:np.ndarray, margin:np.ndarray, tied:np.ndarray) -> tuple:
+    """TrueSkill's V and W functions, the draw versions where tied"""
+    abs_x = np.abs(x)
+    t, a, b = x - margin, margin - abs_x, -margin - abs_x
+    args = np.concatenate([t, a, b])
+    cdf_t, cdf_a, cdf_b = _cdf(args).reshape(3, -1)
+    pdf_t, pdf_a, pdf_b = _pdf(args).reshape(3, -1)
+    #the reference's fallbacks for a vanishing denominator
+    v_win = np.where(cdf_t > 0, pdf_t/np.maximum(cdf_t, 1e-300), -t)
+    w_win = v_win * (v_win + t)
+    denom = np.maximum(cdf_a - cdf_b, 1e-300)
+    v_draw_abs = np.where(cdf_a - cdf_b > 0, (pdf_b - pdf_a)/denom, a)
+    w_draw = v_draw_abs**2 + (a*pdf_a - b*pdf_b)/denom
+
+    v = np.where(tied, np.where(x < 0, -v_draw_abs, v_draw_abs), v_win)
+    w = np.where(tied, w_draw, w_win)
+    #the reference raises once w leaves (0, 1), i.e. when precision runs out on hopeless upsets
+    return v, np.clip(w, 1e-12, 1-1e-12)
+
+_erfc = np.frompyfunc(math.erfc, 1, 1)   #math's per element beats a polynomial fit in numpy on arrays this short
+
+def _cdf(x:np.ndarray) -> np.ndarray:
+    return 0.5*_erfc(-x/math.sqrt(2)).astype(np.float64)
+
+def _pdf(x:np.ndarray) -> np.ndarray:
+    return np.exp(-x*x/2) / math.sqrt(2*math.pi)
 
-    def _calc_updated_ranks_impl(self, curr_ranks:List[Rating], task_info:TaskInfo, leaderboard:pd.DataFrame) -> List[Rating]:
-        scores = leaderboard["scores"]
-        leaderboard_is_sorted = all(scores[i] <= scores[i+1] for i in range(len(scores)-1))
-        assert(leaderboard_is_sorted)
 
-        wrapped_rankings = [[rank.val] for rank in curr_ranks]
-        upd_rankings = trueskill.rate(wrapped_rankings)
-        unwrapped_results = [self.RatingT(tpl[0]) for tpl in upd_rankings]
+def compare_with_trueskill(tasks=200, max_players=30, seed=0) -> float:
+    """largest mu/sigma difference from trueskill.rate over random leaderboards with ties"""
+    ts = _trueskill()
+    rng = np.random.default_rng(seed)
+    logic = TrueSkill()
+    worst = 0.0
+    for _ in range(tasks):
+        n = int(rng.integers(2, max_players+1))
+        mu, sigma = rng.normal(25, 6, n), rng.uniform(1, 8.5, n)
+        scores = np.sort(rng.integers(0, n, n)).astype(float)
+        expected = ts.rate([[ts.Rating(m, s)] for m, s in zip(mu, sigma)], ranks=scores.tolist())
+        new_mu, new_sigma = logic._rate_ffa(mu, sigma, scores[:-1] == scores[1:])
+        worst = max(worst, np.max(np.abs(new_mu - [g[0].mu for g in expected])), np.max(np.abs(new_sigma - [g[0].sigma for g in expected])))
+    return worst
 
-        return unwrapped_results
 
+if __name__ == "__main__":
+    difference = compare_with_trueskill()
+    print(f"largest difference from the trueskill package: {difference:.2e}")
+    assert(difference < 1e-3)
@@ -1,48 +1,162 @@
 from globals import Lang
-import requests
+import page_parser, instrumentation
 import pandas as pd
-from time import perf_counter
+from time import perf_counter, sleep, monotonic
+from threading import Lock
+from multiprocessing import get_context, get_all_start_methods
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+BASE_URL = "https://acmp.ru/index.asp"
+RETRIES = 4
+BACKOFF = 0.5
+MIN_REQUEST_INTERVAL = 0.02  #per host, seconds
 
 def get_task_leaderboard(task_info):
-    def form_url():
-        lang_dict = {
-            Lang.all: "",
-            Lang.cpp: "CPP",
-            Lang.python: "PY",
-            Lang.pascal: "PAS",
-            Lang.java: "JAVA",
-            Lang.csharp: "CS",
-            Lang.basic: "BAS",
-            Lang.go: "GO",
-        }
-        return f"https://acmp.ru/index.asp?main=bstatus&id_t={ task_info.id }&lang={ lang_dict[task_info.lang] }"
-
-    column_names = ["rank", "date", "name", "lang", "runtime", "memory", "code_len"]
-    return _download_table(form_url(), column_names)
+    return _download_table(_leaderboard_url(task_info), page_parser.BSTATUS_COLUMNS)
+
+def get_task_leaderboards(task_info_list, workers=16, parse_workers=0):
+    """yields (task_info, leaderboard) in completion order;
+    parse_workers>0 moves html parsing off the download threads into that many processes"""
+    urls = {task_info: _leaderboard_url(task_info) for task_info in task_info_list}
+    yield from _download_tables(urls, page_parser.BSTATUS_COLUMNS, workers, parse_workers)
 
 def get_accepted_submissions(pages):
-    def form_url(page_no):
-        return f"https://acmp.ru/index.asp?main=tasks&str=%20&page={ page_no }&id_type=0"
+    return pd.concat([_download_table(_task_list_url(page), page_parser.TASKS_COLUMNS) for page in pages])
+
+def get_task_list_pages(pages, workers=16):
+    """yields (page number, task list table) in completion order"""
+    urls = {page: _task_list_url(page) for page in pages}
+    yield from _download_tables(urls, page_parser.TASKS_COLUMNS, workers)
+
+
+def _task_list_url(page_no):
+    return f"{BASE_URL}?main=tasks&str=%20&page={ page_no }&id_type=0"
+
+def _leaderboard_url(task_info):
+    lang_dict = {
+        Lang.all: "",
+        Lang.cpp: "CPP",
+        Lang.python: "PY",
+        Lang.pascal: "PAS",
+        Lang.java: "JAVA",
+        Lang.csharp: "CS",
+        Lang.basic: "BAS",
+        Lang.go: "GO",
+    }
+    return f"{BASE_URL}?main=bstatus&id_t={ task_info.id }&lang={ lang_dict[task_info.lang] }"
+
+
+class _RateLimiter:
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.next_slot = {}
+        self.lock = Lock()
 
-    column_names = ["id", "name", "topic", "sol", "diff", "succ_percent", "acc_no"]
-    return pd.concat([_download_table(form_url(page), column_names) for page in pages])
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        if slot > now:
+            sleep(slot - now)
 
+def _make_session(pool_size=32):
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
+_session = None  #requests is only imported once something is downloaded
+_session_lock = Lock()
+_rate_limiter = _RateLimiter(MIN_REQUEST_INTERVAL)
 
-def _download_table(url, column_names):
-    def download():
-        html = requests.get(url).content #can add verify=False if problems
-        df_list = pd.read_html(html, attrs={'class':'main'}, parse_dates=True)
-        assert(len(df_list)==1)
-        return df_list[0]
-    
-    def preprocess(table):
-        table.columns = column_names
-        return table
-    
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _make_session()
+    return _session
+
+def _get_html(url):
+    with instrumentation.span("fetch"):
+        html = _get_html_with_retries(url)
+    instrumentation.count("pages downloaded")
+    instrumentation.count("bytes downloaded", len(html))
+    return html
+
+def _get_html_with_retries(url):
+    import requests
+    for attempt in range(RETRIES+1):
+        _rate_limiter.wait(url)
+        try:
+            response = _get_session().get(url, timeout=30) #can add verify=False if problems
+            if response.status_code < 500 and response.status_code != 429:
+                response.raise_for_status()
+                return response.content
+            if attempt == RETRIES:
+                response.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == RETRIES:
+                raise
+        sleep(BACKOFF * 2**attempt)
+
+def _download_table(url, columns):
+    html = _get_html(url)
+    with instrumentation.span("parse"):
+        return page_parser.parse_table(html, columns)
+
+def _download_tables(urls, columns, workers, parse_workers=0):
     start_time = perf_counter()
-    print(f"network operation... {url.split('?')[1]:>40}    ", end="", flush=True)
-    ret = preprocess(download())
-    print(f"download took {(perf_counter() - start_time):.3f}s")
+    #forkserver, not fork: the download threads are already running when the pool starts its processes;
+    #Windows has neither and spawns, its default
+    context = get_context("forkserver") if "forkserver" in get_all_start_methods() else None
+    parse_pool = ProcessPoolExecutor(parse_workers, mp_context=context) if parse_workers > 0 else None
+    def download(url):
+        html = _get_html(url)
+        with instrumentation.span("parse"):
+            if parse_pool is None:
+                return page_parser.parse_table(html, columns)
+            return parse_pool.submit(page_parser.parse_table, html, columns).result()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(download, url): key for key, url in urls.items()}
+            for done, future in enumerate(as_completed(futures), 1):
+                yield futures[future], future.result()
+                if done%50==0 or done==len(futures):
+                    elapsed = perf_counter() - start_time
+                    print(f"network operation... {done:>5}/{len(futures):>5} tables, {elapsed:.1f}s ({done/elapsed:.1f}/s)")
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
+
+if __name__ == "__main__":
+    #serves page_parser's sample pages on 127.0.0.1 and points BASE_URL at them
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from threading import Thread
+    from globals import TaskInfo
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            page = page_parser._SAMPLE_TASKS if "main=tasks" in self.path else page_parser._SAMPLE_BSTATUS
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    BASE_URL = f"http://127.0.0.1:{ server.server_port }/index.asp"
 
-    return ret
+    leaderboard = get_task_leaderboard(TaskInfo(1, Lang.cpp))
+    assert(list(leaderboard["code_len"]) == [55, 61] and leaderboard["name"][1] == "Хворых Павел")
+    tables = dict(get_task_leaderboards([TaskInfo(1, Lang.cpp), TaskInfo(2, Lang.python)], workers=2, parse_workers=1))
+    assert(all(table.equals(leaderboard) for table in tables.values()) and len(tables) == 2)
+    assert(list(get_accepted_submissions([0, 1])["acc_no"]) == [41977, 11035]*2)
+    assert(dict(get_task_list_pages([0]))[0]["id"].tolist() == [1, 2])
+    server.shutdown()
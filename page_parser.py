@@ -0,0 +1,92 @@
+from lxml import html as lxml_html
+import numpy as np, pandas as pd, re, sys
+
+#acmp.ru pages hold exactly one table.main; pulling its cells out with XPath skips read_html's generic
+#table heuristics and type inference. Dates stay strings, the leaderboard store parses them on commit.
+BSTATUS_COLUMNS = {
+    "rank":     np.int64,
+    "date":     object,
+    "name":     object,
+    "lang":     object,
+    "runtime":  np.float64,
+    "memory":   np.float64,
+    "code_len": np.int64,
+}
+TASKS_COLUMNS = {
+    "id":           np.int64,
+    "name":         object,
+    "topic":        object,
+    "sol":          object,
+    "diff":         object,
+    "succ_percent": object,
+    "acc_no":       np.int64,
+}
+
+_WHITESPACE = re.compile(r"[\r\n]+|\s{2,}") #what read_html collapses, so names match previously cached ones
+
+def parse_table(html:bytes, columns:dict) -> pd.DataFrame:
+    tables = lxml_html.fromstring(html).xpath('//table[@class="main"]')
+    assert(len(tables)==1)
+    for br in tables[0].iter("br"):   #a line break separates words, as it does for read_html
+        br.tail = "\n" + (br.tail or "")
+    rows = [[_WHITESPACE.sub(" ", td.text_content().strip()) for td in tr.iterchildren("td")] for tr in tables[0].xpath("./tr|./tbody/tr")]
+    rows = [row for row in rows if row] #header rows only have <th>
+    assert(all(len(row)==len(columns) for row in rows))
+    cells = list(zip(*rows)) if rows else [()]*len(columns)
+    return pd.DataFrame({name: _typed(values, dtype) for (name, dtype), values in zip(columns.items(), cells)})
+
+def _typed(values, dtype) -> np.ndarray:
+    if dtype is object:
+        return np.array([sys.intern(v) if v else None for v in values], dtype=object)
+    try:
+        return np.array(values, dtype=str).astype(dtype)
+    except ValueError:
+        #blanks or odd formatting, same NaNs the store's to_numeric would give
+        return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy()
+
+
+def compare_with_read_html(html:bytes, columns:dict) -> list:
+    """names of columns where parse_table and pandas.read_html disagree"""
+    from io import BytesIO
+    expected = pd.read_html(BytesIO(html), attrs={'class':'main'}, parse_dates=True)[0]
+    expected.columns = list(columns)
+    actual = parse_table(html, columns)
+    if len(actual.index) != len(expected.index):
+        return list(columns)
+    mismatches = []
+    for name, dtype in columns.items():
+        if dtype is object:
+            same = (actual[name].fillna("").astype(str) == expected[name].fillna("").astype(str)).all()
+        else:
+            same = np.allclose(actual[name].to_numpy(float), pd.to_numeric(expected[name], errors="coerce").to_numpy(float), equal_nan=True)
+        if not same:
+            mismatches.append(name)
+    return mismatches
+
+
+_SAMPLE_BSTATUS = """<html><head><meta http-equiv="Content-Type" content="text/html; charset=windows-1251"></head><body><table class="main" width="100%">
+<tr class="white"><th>#</th><th>Дата</th><th>Автор</th><th>Язык</th><th>Время</th><th>Память</th><th>Длина</th></tr>
+<tr class="white"><td>1</td><td>01.02.2015 12:00</td><td><a href="?main=user&amp;id=1">Пругло&nbsp;Михаил</a></td><td>GNU C++</td><td>0.015</td><td>1024</td><td>55</td></tr>
+<tr class="white"><td>2</td><td>11.12.2019 09:41</td><td><a href="?main=user&amp;id=2"> Хворых  Павел </a></td><td>GNU C++</td><td>0.1</td><td></td><td>61</td></tr>
+</table></body></html>""".encode("cp1251")
+_SAMPLE_TASKS = """<html><head><meta http-equiv="Content-Type" content="text/html; charset=windows-1251"></head><body><table class="main">
+<tr><th>N</th><th>Название</th><th>Тема</th><th>Решение</th><th>Сложность</th><th>Решаемость</th><th>Решили</th></tr>
+<tr><td>1</td><td><a href="?main=task&amp;id_task=1">A+B</a></td><td>Простая математика</td><td>&nbsp;</td><td>2%</td><td>88%</td><td>41977</td></tr>
+<tr><td>2</td><td>Почти A+B</td><td>Простая математика</td><td>+</td><td>13%</td><td>62%</td><td>11035</td></tr>
+</table></body></html>""".encode("cp1251")
+
+FIXTURES_DIRNAME = "fixtures"  #saved pages the self-check compares against read_html
+
+if __name__ == "__main__":
+    #python page_parser.py [saved pages...], pages with "tasks" in their filename are tasks lists; defaults to the fixtures
+    import os
+    assert(compare_with_read_html(_SAMPLE_BSTATUS, BSTATUS_COLUMNS) == [])
+    assert(compare_with_read_html(_SAMPLE_TASKS, TASKS_COLUMNS) == [])
+    assert(parse_table(_SAMPLE_BSTATUS, BSTATUS_COLUMNS)["name"][1] == "Хворых Павел")
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), FIXTURES_DIRNAME)
+    for filename in sys.argv[1:] or sorted(os.path.join(fixtures, f) for f in os.listdir(fixtures)):
+        with open(filename, 'rb') as f:
+            page = f.read()
+        mismatches = compare_with_read_html(page, TASKS_COLUMNS if "tasks" in os.path.basename(filename) else BSTATUS_COLUMNS)
+        print(f"{filename}: {'ok' if not mismatches else 'mismatch in ' + ', '.join(mismatches)}")
+        assert(sys.argv[1:] or not mismatches)
@@ -0,0 +1,111 @@
+from globals import *
+from rating_system import RatingSystem, _map_in_pool, _worker_eval_accuracy
+from rating_system_tools import ScoringManager, DifficultyManager
+from elo import SME_EvE, ELO, MOV
+from skill_points import TMX_max
+from durable import WriteAheadLog
+import rating_system_evaluator as evaluator
+import itertools, json, os, random, numpy as np, pandas as pd
+
+#candidates are dicts of parameters, make_system(params) turns one into a RatingSystem.
+#All candidates are scored on the same tasks and splits, so their accuracies compare directly.
+
+_SWEEP_DIRNAME = "dbcache/sweeps"   #<name>.jsonl per sweep, one line per finished candidate
+
+_DIFFICULTY_PARAMS = ("AS_C", "AS_A", "AS_B", "LEN_C", "LEN_A", "PS_A")
+
+def elo_system(params) -> RatingSystem:
+    """SME_EvE over MOV(stdev), or over ELO(sigma, k) when there is no stdev"""
+    elo = MOV(params["stdev"]) if "stdev" in params else ELO(params.get("sigma", 200), params.get("k", 32))
+    return RatingSystem(SME_EvE(elo, _difficulty_mgr(params)), _scoring_mgr(params), description="elo " + _key(params))
+
+def tmx_system(params) -> RatingSystem:
+    return RatingSystem(TMX_max(_difficulty_mgr(params), params.get("distrib_f_k", 0.29)), _scoring_mgr(params), description="tmx " + _key(params))
+
+ELO_SPACE = {"stdev": [5, 7, 10], "AS_C": [0.3, 0.5, 0.7], "LEN_C": [0.5, 0.7, 0.9], "percent_spread": [10, 15, 20]}
+TMX_SPACE = {"distrib_f_k": [0.2, 0.29, 0.4], "AS_C": [0.3, 0.5, 0.7], "LEN_C": [0.5, 0.7, 0.9], "percent_spread": [10, 15, 20]}
+
+
+def grid(space:dict) -> list:
+    """every combination of space's value lists"""
+    return [dict(zip(space, values)) for values in itertools.product(*space.values())]
+
+def random_search(space:dict, n:int, seed=0) -> list:
+    """n candidates; lists are sampled from, (lo, hi) tuples drawn uniformly (integers if both ends are)"""
+    rng = random.Random(seed)
+    def draw(values):
+        if isinstance(values, tuple):
+            lo, hi = values
+            return rng.randint(lo, hi) if isinstance(lo, int) and isinstance(hi, int) else rng.uniform(lo, hi)
+        return rng.choice(values)
+    return [{name: draw(values) for name, values in space.items()} for _ in range(n)]
+
+def as_ranges(space:dict) -> dict:
+    """(min, max) of each value list, to search a grid's span randomly"""
+    return {name: (min(values), max(values)) for name, values in space.items()}
+
+
+def sweep(make_system, candidates, name, tasks=1000, runs=3, folds=0, langs=(Lang.cpp,), workers=None, seed=0) -> pd.DataFrame:
+    """accuracy of every candidate over runs random splits (or runs k-fold rounds); finished candidates
+    are appended to dbcache/sweeps/<name>.jsonl, so an interrupted sweep resumes where it stopped"""
+    setup = {"tasks": tasks, "runs": runs, "folds": folds, "langs": [lang.name for lang in langs], "seed": seed}
+    log = WriteAheadLog(os.path.join(_SWEEP_DIRNAME, name + ".jsonl"))
+    done = {_key(r["params"]): r for r in log.replay() if r["setup"] == setup}
+    todo = [params for params in candidates if _key(params) not in done]
+    print(f"sweep {name}: {len(candidates)-len(todo)} candidates cached, {len(todo)} to evaluate")
+
+    if todo:
+        data = evaluator._load_data(tasks, langs, random.Random(seed))
+        splits = evaluator._make_splits(len(data), False, runs, folds, np.random.default_rng(seed))
+        systems = [make_system(params) for params in todo]
+        for rat_sys in systems:     #filled once here, the pool hands the task cache to every worker
+            rat_sys.precompute(data)
+        jobs = [(rat_sys, training, evaluation) for rat_sys in systems for training, evaluation in splits]
+        if workers is None or workers <= 1:
+            accuracies = (_eval_accuracy(data, *job) for job in jobs)
+        else:
+            accuracies = _map_in_pool(data, _worker_eval_accuracy, jobs, workers)
+        for i, params in enumerate(todo):
+            values = [next(accuracies) for _ in splits]
+            record = {"params": _jsonable(params), "setup": setup, "accuracy": float(np.mean(values)), "std": float(np.std(values)), "splits": len(values)}
+            log.append(record)
+            done[_key(params)] = record
+            print(f"sweep {name}: {i+1:>4}/{len(todo):>4}  {record['accuracy']:.3f}  {_key(params)}")
+
+    results = [done[_key(params)] for params in candidates]
+    frame = pd.DataFrame([{**r["params"], "accuracy": r["accuracy"], "std": r["std"]} for r in results])
+    frame["frontier"] = _pareto_front(frame["accuracy"].to_numpy(), frame["std"].to_numpy()) if len(results) else []
+    return frame
+
+def print_report(results:pd.DataFrame, top=20) -> None:
+    """best candidates and the accuracy/stability frontier; accuracy is a distance, lower is better"""
+    print(f"\n{len(results.index)} candidates, best {top}:")
+    print(results.sort_values("accuracy").head(top).to_string(index=False))
+    print("\nfrontier (no candidate is both more accurate and more stable):")
+    print(results[results["frontier"]].sort_values("accuracy").to_string(index=False))
+
+
+def _eval_accuracy(data, rat_sys:RatingSystem, training, evaluation) -> float:
+    return rat_sys._rate_and_eval(data, training, evaluation)[1]
+
+def _pareto_front(accuracy:np.ndarray, std:np.ndarray) -> np.ndarray:
+    order = np.lexsort((std, accuracy))
+    front = np.zeros(len(accuracy), dtype=bool)
+    best_std = np.inf
+    for i in order:
+        if std[i] < best_std:
+            front[i] = True
+            best_std = std[i]
+    return front
+
+def _difficulty_mgr(params) -> DifficultyManager:
+    return DifficultyManager(**{name: params[name] for name in _DIFFICULTY_PARAMS if name in params})
+
+def _scoring_mgr(params) -> ScoringManager:
+    return ScoringManager(params.get("percent_spread", 15))
+
+def _jsonable(params) -> dict:
+    return {name: value.item() if isinstance(value, np.generic) else value for name, value in params.items()}
+
+def _key(params) -> str:
+    return json.dumps(_jsonable(params), sort_keys=True)
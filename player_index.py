@@ -0,0 +1,59 @@
+from leaderboard_store import LeaderboardStore
+from typing import NamedTuple, Dict, List
+
+class Posting(NamedTuple):
+    task_id: int
+    rank: int       #rank on the site leaderboard
+    code_len: int
+    pos: int        #row within the task record, i.e. index into its scores
+
+#player -> postings and task -> players, so per-player views don't have to scan every leaderboard
+class PlayerIndex:
+    def __init__(self):
+        self.generations = {}      #store path -> generation it was indexed at
+        self._postings = {}         #name -> {task key: Posting}
+        self._task_players = {}     #task key -> set of names
+
+    def tasks_of(self, name) -> Dict[str, Posting]:
+        return self._postings.get(name, {})
+
+    def players_of(self, task_key) -> set:
+        return self._task_players.get(task_key, set())
+
+    def head_to_head(self, name1, name2) -> Dict[str, tuple]:
+        tasks1, tasks2 = self.tasks_of(name1), self.tasks_of(name2)
+        return {key: (tasks1[key], tasks2[key]) for key in tasks1.keys() & tasks2.keys()}
+
+    def unsolved_by(self, name, task_keys) -> List[str]:
+        solved = self.tasks_of(name)
+        return [key for key in task_keys if key not in solved]
+
+    def update(self, store:LeaderboardStore, task_keys) -> None:
+        """re-reads task_keys from store; keys no longer in it are dropped"""
+        for key in task_keys:
+            self._remove_task(key)
+            if key in store:
+                self._add_task(store, key)
+        self.generations[store.path] = store.generation
+
+    def rebuild(self, stores:List[LeaderboardStore]) -> None:
+        self._postings, self._task_players, self.generations = {}, {}, {}
+        for store in stores:
+            self.update(store, [str(k) for k in store.keys])
+
+    def _add_task(self, store:LeaderboardStore, key) -> None:
+        rows = store.task_rows(key)
+        names = store.names[store.columns["name_id"][rows]].tolist()
+        task_id = int(store.columns["task_id"][rows.start]) if len(names) else 0
+        ranks = store.columns["rank"][rows].tolist()
+        code_len = store.columns["code_len"][rows].tolist()
+        for pos, (name, rank, length) in enumerate(zip(names, ranks, code_len)):
+            self._postings.setdefault(name, {})[key] = Posting(task_id, rank, length, pos)
+        self._task_players[key] = set(names)
+
+    def _remove_task(self, key) -> None:
+        for name in self._task_players.pop(key, ()):
+            postings = self._postings[name]
+            del postings[key]
+            if not postings:
+                del self._postings[name]
@@ -0,0 +1,28 @@
+import numpy as np
+
+#dense integer ids for player names, shared by everything loaded in this process
+_ids = {}
+_names = []
+_names_array = np.empty(0, dtype=object)
+
+def intern(names) -> np.ndarray:
+    ids = np.empty(len(names), dtype=np.int32)
+    for i, name in enumerate(names):
+        id = _ids.get(name)
+        if id is None:
+            id = _ids[name] = len(_names)
+            _names.append(name)
+        ids[i] = id
+    return ids
+
+def count() -> int:
+    return len(_names)
+
+def get_id(name) -> int:
+    return _ids[name]
+
+def names() -> np.ndarray:
+    global _names_array
+    if len(_names_array) != len(_names):
+        _names_array = np.array(_names, dtype=object)
+    return _names_array
@@ -1,8 +1,9 @@
 from globals import *
 from rating_system_tools import *
-import pandas as pd, statistics, random
-from typing import List, DefaultDict
-from collections import defaultdict
+import pandas as pd, numpy as np, random, players, instrumentation
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict
 
 class Rating:
     def __init__(self, val=None) -> None:
@@ -28,69 +29,278 @@ class Rating:
 
 class RatingSystemLogic:
     RatingT = Rating
+    ORDER_INDEPENDENT = False   #rating change from a task doesn't depend on current ratings
 
-    def calc_updated_ranks(self, curr_ranks:List[Rating], task_info:TaskInfo, leaderboard:pd.DataFrame) -> List[Rating]:
-        assert(len(curr_ranks) == len(leaderboard.index))
-        assert("scores" in leaderboard.columns)
-        return self._calc_updated_ranks_impl(curr_ranks, task_info, leaderboard)
+    def calc_updated_ranks(self, curr_ranks:np.ndarray, task_info:TaskInfo, record:TaskRecord) -> np.ndarray:
+        assert(len(curr_ranks) == len(record.player_ids))
+        assert(record.scores is not None)
+        return self._calc_updated_ranks_impl(curr_ranks, task_info, record)
 
-    def _calc_updated_ranks_impl(self, curr_ranks:List[Rating], task_info:TaskInfo, leaderboard:pd.DataFrame) -> List[Rating]:
+    def _calc_updated_ranks_impl(self, curr_ranks:np.ndarray, task_info:TaskInfo, record:TaskRecord) -> np.ndarray:
         pass
 
+    def calc_joined_ranks(self, curr_ranks:np.ndarray, task_info:TaskInfo, record:TaskRecord, joined:np.ndarray) -> np.ndarray:
+        """ratings after the players flagged in joined enter a field the others are already in, counting only
+        what involves the newcomers; None if the logic can only rate a field as a whole"""
+        return None
+
+    def precompute(self, data_list) -> None:
+        pass
+
+    def new_ratings(self, n:int) -> np.ndarray:
+        return np.full(n, self.RatingT.default_val(), dtype=np.float64)
+
+    def to_float(self, ratings:np.ndarray) -> np.ndarray:
+        return ratings
+
+    def to_rating(self, val) -> Rating:
+        return self.RatingT(float(val))
+
 
 class RatingSystem:
     def __init__(self, logic:RatingSystemLogic, scoring_mgr:ScoringManager=ScoringManager(), description="n/a"):
         self.logic = logic
         self.scoring_mgr = scoring_mgr
-        self.rankings : DefaultDict[str, Rating] = defaultdict(logic.RatingT)
         self.description = description
+        self.set_initial_ratings(None)
 
-    def rate(self, data_list) -> DefaultDict[str, Rating]:
-        for task_info, leaderboard in data_list:
-            leaderboard["scores"] = self.scoring_mgr.get_scores(leaderboard)
-            curr_ranks = [self.rankings[name] for name in leaderboard["name"]]
-            new_ranks = self.logic.calc_updated_ranks(curr_ranks, task_info, leaderboard)
-            for name, new_r in zip(leaderboard["name"], new_ranks):
-                self.rankings[name] = new_r
-
-            if PRINT_LEADERBOARD:
-                leaderboard["curr_ranks"] = curr_ranks
-                leaderboard["new_ranks"] = new_ranks
-                leaderboard["dranks"] = [float(new)-float(old) for new,old in zip(new_ranks,curr_ranks)]
-                print(leaderboard)
- 
+    @property
+    def rankings(self) -> Dict[str, Rating]:
+        ids = np.flatnonzero(self._seen)
+        return {name: self.logic.to_rating(r) for name, r in zip(players.names()[ids], self._ratings[ids])}
+
+    def rate(self, data_list) -> Dict[str, Rating]:
+        self._rate(data_list)
         return self.rankings
 
-    def rate_multiple_runs(self, data_list, runs:int) -> DefaultDict[str, Rating]:
-        result_dict = defaultdict(float)
-        for i in range(runs):
-            if i%10==0: print(f"rate_multiple_runs {self.description}: run {i:>4}/{runs:>4}")
-            self.reset()
-            random.shuffle(data_list)
-            for name, rat in self.rate(data_list).items():
-                result_dict[name] += float(rat) / runs
-        return result_dict
+    def rate_multiple_runs(self, data_list, runs:int, workers:int=None, seed:int=None, tolerance:float=None, top:int=None) -> Dict[str, float]:
+        """averages runs passes over independently shuffled data; run i is shuffled with seed+i,
+        so the result only depends on seed, not on the number of workers. See rate_with_errors for
+        tolerance and top, which stop early once the average has settled."""
+        return self.rate_with_errors(data_list, runs, workers, seed, tolerance, top)["rating"].to_dict()
+
+    def rate_with_errors(self, data_list, runs:int, workers:int=None, seed:int=None, tolerance:float=None, top:int=None) -> pd.DataFrame:
+        """rate_multiple_runs' averages with their standard error and 95% confidence interval; after
+        MIN_ADAPTIVE_RUNS runs, stops once every stderr is within tolerance or the top players' order settles"""
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.precompute(data_list)
+        chunks = [range(i, min(i+_RUNS_PER_CHUNK, runs)) for i in range(0, runs, _RUNS_PER_CHUNK)]
+        if workers is None or workers <= 1:
+            chunk_stats = (self._rate_runs(data_list, chunk, seed) for chunk in chunks)
+        else:
+            chunk_stats = _map_in_pool(data_list, _worker_rate_runs, [(self, chunk, seed) for chunk in chunks], workers)
+
+        ids = np.unique(np.concatenate([record.player_ids for _, record in data_list]))
+        n, mean, m2 = 0, np.zeros(players.count()), np.zeros(players.count())
+        top_order = None
+        for chunk, (chunk_mean, chunk_m2) in zip(chunks, chunk_stats):
+            n, mean, m2 = _merge_moments(n, mean, m2, len(chunk), chunk_mean, chunk_m2)
+            stderr = _stderr(n, m2[ids])
+            print(f"rate_multiple_runs {self.description}: run {chunk.stop:>4}/{runs:>4}  largest stderr {np.max(stderr, initial=0):.3f}")
+            if n < MIN_ADAPTIVE_RUNS:
+                continue
+            if tolerance is not None and np.max(stderr, initial=0) <= tolerance:
+                print(f"rate_multiple_runs {self.description}: every stderr within {tolerance} after {n} runs")
+                break
+            if top is not None:
+                order = ids[np.argsort(-mean[ids], kind="stable")[:top]]
+                if top_order is not None and np.array_equal(order, top_order):
+                    print(f"rate_multiple_runs {self.description}: top {top} settled after {n} runs")
+                    break
+                top_order = order
+        chunk_stats.close()     #a pool cancels the chunks it hasn't started
+
+        stderr = _stderr(n, m2[ids])
+        return pd.DataFrame({"rating": mean[ids], "stderr": stderr, "ci95": 1.96*stderr, "runs": n}, index=players.names()[ids])
+
+    def precompute(self, data_list) -> None:
+        self.scoring_mgr.precompute(data_list)
+        self.logic.precompute(data_list)
+
+    def cross_validate(self, data_list, splits, workers:int=None):
+        """yields (ratings, accuracy) for each (training indices, eval indices) split of data_list:
+        ratings by player id after rating the training tasks in the given order (NaN for players
+        not in them), accuracy on the eval tasks. Splits are independent so they run in parallel."""
+        self.precompute(data_list)
+        if workers is None or workers <= 1:
+            yield from (self._rate_and_eval(data_list, training, evaluation) for training, evaluation in splits)
+        else:
+            yield from _map_in_pool(data_list, _worker_rate_and_eval, [(self, training, evaluation) for training, evaluation in splits], workers)
 
     def eval_accuracy(self, data_list) -> float:
-        return statistics.mean([self._eval_accuracy_task(task_info, leaderboard) for task_info, leaderboard in data_list])
+        return float(np.mean(self._eval_accuracy_norms(data_list)))
+
+    def set_initial_ratings(self, ratings:Dict[str, float]) -> None:
+        """players start from these instead of the default rating, None to go back to defaults"""
+        self._initial = None if ratings is None else (players.intern(list(ratings)), np.fromiter(ratings.values(), float, len(ratings)))
+        self.reset()
 
     def reset(self) -> None:
-        self.rankings = defaultdict(self.logic.RatingT)
+        self._ratings = self.logic.new_ratings(players.count())
+        self._seen = np.zeros(players.count(), dtype=bool)
+        if self._initial is not None:
+            ids, values = self._initial
+            self._ratings[ids] = values
+            self._seen[ids] = True
+
+    def _rate(self, data_list) -> None:
+        with instrumentation.span("rating pass"):
+            for task_info, record in data_list:
+                record = record._replace(scores=self.scoring_mgr.get_task_scores(task_info, record))
+                ids = record.player_ids
+                self._grow(players.count())
+                curr_ranks = self._ratings[ids]
+                new_ranks = self.logic.calc_updated_ranks(curr_ranks, task_info, record)
+                self._ratings[ids] = new_ranks
+                self._seen[ids] = True
+
+                if instrumentation.debug_leaderboard:
+                    print(pd.DataFrame({
+                        "name":       record.names,
+                        "code_len":   record.code_len,
+                        "scores":     record.scores,
+                        "curr_ranks": self.logic.to_float(curr_ranks),
+                        "new_ranks":  self.logic.to_float(new_ranks),
+                        "dranks":     self.logic.to_float(new_ranks) - self.logic.to_float(curr_ranks),
+                    }))
+        instrumentation.count("tasks rated", len(data_list))
+
+    def _rate_runs(self, data_list, run_indices, seed:int) -> tuple:
+        """mean and sum of squared deviations (Welford) of every player's rating over the runs"""
+        n, mean, m2 = 0, np.zeros(0), np.zeros(0)
+        for i in run_indices:
+            order = list(range(len(data_list)))
+            random.Random(seed+i).shuffle(order)
+            self.reset()
+            self._rate([data_list[j] for j in order])
+            n, mean, m2 = _merge_moments(n, mean, m2, 1, np.asarray(self.logic.to_float(self._ratings), dtype=np.float64), np.zeros(len(self._ratings)))
+        return mean, m2
+
+    def _rate_and_eval(self, data_list, training, evaluation) -> tuple:
+        self.reset()
+        self._rate([data_list[i] for i in training])
+        ratings = np.array(self.logic.to_float(self._ratings), dtype=np.float64)
+        ratings[~self._seen] = np.nan
+        return ratings, self.eval_accuracy([data_list[i] for i in evaluation])
+
+    def _grow(self, n:int) -> None:
+        if n > len(self._ratings):
+            self._ratings = np.concatenate([self._ratings, self.logic.new_ratings(n-len(self._ratings))])
+            self._seen = np.concatenate([self._seen, np.zeros(n-len(self._seen), dtype=bool)])
+
+    def _eval_accuracy_norms(self, data_list) -> np.ndarray:
+        """distance between actual scores and the ones current ratings predict, for all tasks at once"""
+        data_list = [(task_info, record) for task_info, record in data_list if len(record.player_ids)]
+        if not data_list:
+            return np.zeros(0)
+        self._grow(players.count())
+        ids = np.concatenate([record.player_ids for _, record in data_list])
+        scores = np.concatenate([self.scoring_mgr.get_task_scores(task_info, record) for task_info, record in data_list])
+        starts = np.cumsum([0]+[len(record.player_ids) for _, record in data_list])[:-1]
+        sizes = np.diff(np.append(starts, len(ids)))
+
+        curr_ranks = self.logic.to_float(self._ratings[ids])
+        lo = np.repeat(np.minimum.reduceat(curr_ranks, starts), sizes)
+        span = np.repeat(np.maximum.reduceat(curr_ranks, starts), sizes) - lo
+        exp_scores = np.where(span == 0, sum(SCORE_RANGE)/2,
+            SCORE_RANGE[1] - (curr_ranks-lo)/np.where(span == 0, 1, span)*(SCORE_RANGE[1]-SCORE_RANGE[0]))
+        norms = np.sqrt(np.add.reduceat((scores-exp_scores)**2, starts))
+
+        if instrumentation.debug_leaderboard:
+            for (task_info, record), start, size in zip(data_list, starts, sizes):
+                rows = slice(start, start+size)
+                print(pd.DataFrame({
+                    "name":       record.names,
+                    "code_len":   record.code_len,
+                    "curr_ranks": curr_ranks[rows],
+                    "scores":     scores[rows],
+                    "exp_scores": exp_scores[rows],
+                }))
+        return norms
+
+
+_RUNS_PER_CHUNK = 5
+MIN_ADAPTIVE_RUNS = 10  #runs before an early stop is considered, so that two chunks can be compared
+
+def _merge_moments(n_a:int, mean_a:np.ndarray, m2_a:np.ndarray, n_b:int, mean_b:np.ndarray, m2_b:np.ndarray) -> tuple:
+    """count, mean and m2 of two sets of runs combined (Chan et al.); the shorter arrays are zero-padded"""
+    size = max(len(mean_a), len(mean_b))
+    pad = lambda arr: np.concatenate([arr, np.zeros(size-len(arr))])
+    mean_a, m2_a, mean_b, m2_b = pad(mean_a), pad(m2_a), pad(mean_b), pad(m2_b)
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta*n_b/n, m2_a + m2_b + delta**2*n_a*n_b/n
+
+def _stderr(n:int, m2:np.ndarray) -> np.ndarray:
+    """standard error of the mean from the sample variance, NaN until there are two runs"""
+    return np.sqrt(m2/(n-1)/n) if n > 1 else np.full(len(m2), np.nan)
+
+def _map_in_pool(data_list, worker_f, jobs, workers:int):
+    """yields worker_f(*job) for each job, run by workers that share data_list (and its task cache);
+    what the workers' instrumentation collects is merged into this process's"""
+    shared = _SharedTasks(data_list)
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(shared.specs, shared.task_infos, players.names(), export_task_cache(shared.task_infos), instrumentation.worker_settings())) as pool:
+            try:
+                for result, collected in pool.map(_instrumented, [worker_f]*len(jobs), *zip(*jobs)):
+                    instrumentation.merge(collected)
+                    yield result
+            finally:
+                pool.shutdown(cancel_futures=True)
+    finally:
+        shared.close()
+
+class _SharedTasks:
+    """task records packed into shared memory once, instead of pickling every record to every worker;
+    their precomputed scores and difficulties travel along as the task cache"""
+    def __init__(self, data_list):
+        self.task_infos = [task_info for task_info, _ in data_list]
+        records = [record for _, record in data_list]
+        arrays = {
+            "offsets":    np.cumsum([0]+[len(r.player_ids) for r in records]),
+            "code_len":   np.concatenate([r.code_len for r in records]),
+            "player_ids": np.concatenate([r.player_ids for r in records]),
+        }
+        self._blocks = []
+        self.specs = {}
+        for name, arr in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, arr.dtype, buffer=block.buf)[:] = arr
+            self._blocks.append(block)
+            self.specs[name] = (block.name, arr.shape, arr.dtype.str)
+
+    def close(self) -> None:
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+_worker_blocks = {}
+_worker_data = None
+def _init_worker(specs, task_infos, names, task_cache, instrumentation_settings) -> None:
+    global _worker_blocks, _worker_data
+    if instrumentation_settings is not None:
+        instrumentation.enable(debug=instrumentation_settings)
+    players.intern(names)
+    import_task_cache(task_cache)
+    _worker_blocks = {name: shared_memory.SharedMemory(name=block_name) for name, (block_name, _, _) in specs.items()}
+    arrays = {name: np.ndarray(shape, dtype, buffer=_worker_blocks[name].buf) for name, (_, shape, dtype) in specs.items()}
+    for arr in arrays.values():
+        arr.flags.writeable = False
+    rows = lambda i: slice(arrays["offsets"][i], arrays["offsets"][i+1])
+    _worker_data = [
+        (task_info, TaskRecord(arrays["player_ids"][rows(i)], arrays["code_len"][rows(i)]))
+        for i, task_info in enumerate(task_infos)
+    ]
 
-    def _eval_accuracy_task(self, _, leaderboard) -> float:
-        curr_ranks = [self.rankings[name] for name in leaderboard["name"]]
-        scores = self.scoring_mgr.get_scores(leaderboard)
-        exp_scores = [
-            hlp.interpolate_inverse(float(x), float(min(curr_ranks)), float(max(curr_ranks)), *SCORE_RANGE) 
-            for x in curr_ranks
-        ]
-        norm = np.linalg.norm(np.array(scores)-np.array(exp_scores))
+def _instrumented(worker_f, *args) -> tuple:
+    return worker_f(*args), instrumentation.collect()
 
-        if PRINT_LEADERBOARD:
-            leaderboard["curr_ranks"] = leaderboard["new_ranks"] = curr_ranks
-            leaderboard["scores"] = scores
-            leaderboard["exp_scores"] = exp_scores
-            print(leaderboard)
+def _worker_rate_runs(rat_sys:RatingSystem, run_indices, seed:int) -> tuple:
+    return rat_sys._rate_runs(_worker_data, run_indices, seed)
 
-        return norm
+def _worker_rate_and_eval(rat_sys:RatingSystem, training, evaluation) -> tuple:
+    return rat_sys._rate_and_eval(_worker_data, training, evaluation)
 
+def _worker_eval_accuracy(rat_sys:RatingSystem, training, evaluation) -> float:
+    return rat_sys._rate_and_eval(_worker_data, training, evaluation)[1]
@@ -1,67 +1,88 @@
-import random, statistics, pickle, numpy as np, matplotlib.pyplot as plt
+import random, statistics, os, numpy as np, pandas as pd
 from dataclasses import dataclass, field
 from globals import *
 from rating_system import RatingSystem
-import database, helpers as hlp
+from durable import atomic_write
+import database, players, helpers as hlp
 
 @dataclass
 class RatingHistory:
-    mean: float = 0.0
-    std: float = 0.0
-    history: list = field(default_factory=list)
-
-    def add_rating(self, val):
-        self.history.append(val)
-        self.mean = statistics.mean([float(x) for x in self.history])
-        if len(self.history) > 1:
-            self.std = statistics.pstdev([float(x) for x in self.history], self.mean)
-
-
-def evaluate(rat_systems, runs_p=1, runs_nonp=10, tasks=1000):
-    with open(_ACCURACY_DIST_GRAPH_FILENAME, 'rb') as f:
-        pickle.load(f)
+    """mean and population stdev of every player's rating across runs, updated online (Welford)"""
+    n:    np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int64))
+    mean: np.ndarray = field(default_factory=lambda: np.zeros(0))
+    m2:   np.ndarray = field(default_factory=lambda: np.zeros(0))
+
+    def add_ratings(self, ratings:np.ndarray) -> None:
+        """ratings by player id, NaN for players not rated in this run"""
+        if len(ratings) > len(self.n):
+            grow = len(ratings) - len(self.n)
+            self.n, self.mean, self.m2 = np.append(self.n, np.zeros(grow, np.int64)), np.append(self.mean, np.zeros(grow)), np.append(self.m2, np.zeros(grow))
+        ids = np.flatnonzero(~np.isnan(ratings))
+        self.n[ids] += 1
+        delta = ratings[ids] - self.mean[ids]
+        self.mean[ids] += delta / self.n[ids]
+        self.m2[ids] += delta * (ratings[ids] - self.mean[ids])
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.m2 / np.maximum(self.n, 1))
+
+    def frame(self) -> pd.DataFrame:
+        ids = np.flatnonzero(self.n)
+        return pd.DataFrame({"name": players.names()[ids], "mean": self.mean[ids], "std": self.std[ids], "runs": self.n[ids]})
+
+
+def evaluate(rat_systems, runs_p=1, runs_nonp=10, tasks=1000, langs=(Lang.cpp,), folds=0, workers=None):
+    """persistent runs rate one fixed training set in different orders, the others draw a new split each run;
+    folds>1 turns each of those runs into a k-fold cross-validation"""
+    import matplotlib.pyplot as plt
+    _plot_accuracy_dist()
     colors = ["C"+str(i) for i in range(1, len(rat_systems)+1)]
 
     for rs, color in zip(rat_systems, colors):
-        if runs_p:    _eval_class(rs, tasks, True,  runs_p,    color)
-        if runs_nonp: _eval_class(rs, tasks, False, runs_nonp, color)
+        if runs_p:    _eval_class(rs, tasks, True,  runs_p,    color, langs, folds, workers)
+        if runs_nonp: _eval_class(rs, tasks, False, runs_nonp, color, langs, folds, workers)
 
     plt.legend()
     plt.show()
 
 
 
-def _eval_class(rat_sys:RatingSystem, task_no, persistent=True, runs=1, graphing_color="#3ded97"):
-    ratings: dict[str, RatingHistory] = {}
-    data =_load_data(task_no)
-    training_data, eval_data = _split_data(data)
+def _eval_class(rat_sys:RatingSystem, task_no, persistent=True, runs=1, graphing_color="#3ded97", langs=(Lang.cpp,), folds=0, workers=None):
+    data =_load_data(task_no, langs)
+    splits = _make_splits(len(data), persistent, runs, folds)
+    ratings = RatingHistory()
     accuracies = []
-    for i in range(runs):
-        if i%10==0: print(f"{rat_sys.description}: run {i:>4}/{runs:>4}")
-        
-        if persistent:
-            random.shuffle(training_data)
-        else:
-            training_data, eval_data = _split_data(data)
-        rat_sys.reset()
-        run_ratings = rat_sys.rate(training_data)
-        accuracies.append(rat_sys.eval_accuracy(eval_data))
-        for name, rating in run_ratings.items():
-            ratings.setdefault(name, RatingHistory()).add_rating(rating)
+    for i, (run_ratings, accuracy) in enumerate(rat_sys.cross_validate(data, splits, workers)):
+        if i%10==0: print(f"{rat_sys.description}: run {i:>4}/{len(splits):>4}")
+        ratings.add_ratings(run_ratings)
+        accuracies.append(accuracy)
     _print_results(rat_sys.description, ratings, accuracies, persistent, graphing_color)
 
-def _load_data(task_no=1000):
-    data = []
-    ids = random.sample(range(1,1001), task_no) if task_no<1000 else list(range(1,1001))
-    for id in ids:
-        task_info = TaskInfo(id, Lang.cpp, database.get_accepted_submissions(id))
-        leaderboard = database.get_task_leaderboard(task_info)
-        data.append((task_info, leaderboard))
-    return data
-
-def _split_data(data):
+def _load_data(task_no=1000, langs=(Lang.cpp,), rng=random):
+    all_ids = database.get_task_ids()
+    ids = rng.sample(all_ids, task_no) if task_no<len(all_ids) else all_ids
+    return [x for lang in langs for x in database.get_rating_data(ids, lang)]
+
+def _make_splits(n, persistent=True, runs=1, folds=0, rng=np.random) -> list:
+    """(training indices in rating order, eval indices) for every run"""
+    if folds > 1:
+        splits = []
+        for _ in range(1 if persistent else runs):
+            order = rng.permutation(n)
+            for fold in np.array_split(order, folds):
+                splits.append((np.setdiff1d(order, fold, assume_unique=True), fold))
+        if persistent:  #the same folds, each rated in a new order every run
+            splits = [(rng.permutation(training), fold) for _ in range(runs) for training, fold in splits]
+        return splits
+    if persistent:
+        training, evaluation = _split_data(np.arange(n), rng)
+        return [(rng.permutation(training), evaluation) for _ in range(runs)]
+    return [_split_data(np.arange(n), rng) for _ in range(runs)]
+
+def _split_data(data, rng=np.random):
     TRAINING_TASKS = len(data)*9//10
-    random.shuffle(data)
+    data = rng.permutation(data)
     return data[:TRAINING_TASKS], data[TRAINING_TASKS:]
 
 def _print_results(rs_name, ratings, accuracies, persistent, graphing_color):
@@ -70,14 +91,16 @@ def _print_results(rs_name, ratings, accuracies, persistent, graphing_color):
         print("\n\n"+"="*111)
         print(f"rating system: {rs_name}")
         print(f"accuracy:      {avg_accuracy:.3f}")
-        print(f"stdev:         {statistics.mean([rh.std for rh in ratings.values()]):.3f}")
+        print(f"stdev:         {ratings.std[ratings.n > 0].mean():.3f}")
         print()
     
     def _print_rankings():
-        for i, (name, hist) in enumerate(sorted(ratings.items(), key=lambda x: x[1].mean, reverse=True)[:20]):
-            print(f"{i+1:>3} {name:<32} {hist.mean:>12.3f} {hist.std:>10.2f}    ", hist.history)
+        top = ratings.frame().nlargest(20, "mean")
+        for i, (name, mean, std, runs) in enumerate(top.itertuples(index=False)):
+            print(f"{i+1:>3} {name:<32} {mean:>12.3f} {std:>10.2f}    {runs} runs")
     
     def _plot_vertical_lines():
+        import matplotlib.pyplot as plt
         if persistent:
             plt.axvline(avg_accuracy, color=graphing_color, linestyle="-.", label=rs_name + " persistent")
         else:
@@ -96,38 +119,54 @@ def _print_results(rs_name, ratings, accuracies, persistent, graphing_color):
     _plot_vertical_lines()
 
 
-_ACCURACY_DIST_GRAPH_FILENAME = "dbcache/accuracy_dist.p"
-def _cache_accuracy_dist_graph(N = 10000):
-    SCORES_NO = 20
+_ACCURACY_DIST_FILENAME = "dbcache/accuracy_dist.npz"    #histogram and moments of the accuracy of random guessing
+_ACCURACY_DIST_CHUNK = 100000                               #score vectors generated at once
+
+def _cache_accuracy_dist(N=1000000, seed=None):
+    """accuracy (norm of score differences) of N random leaderboards against one random standard,
+    generated _ACCURACY_DIST_CHUNK rows at a time into a histogram over every norm two score vectors can have"""
+    SCORES_NO, BINS = 20, 900
+    rng = np.random.default_rng(seed)
 
-    def get_scores():
-        v = np.random.default_rng().uniform(SCORE_RANGE[0]+1e-6, SCORE_RANGE[1]+1e-6, SCORES_NO-2)
-        v = np.insert(v, np.random.randint(0, len(v)), SCORE_RANGE[0])
-        v = np.insert(v, np.random.randint(0, len(v)), SCORE_RANGE[1])
+    def get_scores(n):
+        v = np.empty((n, SCORES_NO))
+        v[:, :-2] = rng.uniform(SCORE_RANGE[0]+1e-6, SCORE_RANGE[1]+1e-6, (n, SCORES_NO-2))
+        v[:, -2:] = SCORE_RANGE
         return v
 
-    print("caching accurasy dist graph... ", end="", flush=True)
-    standard = np.sort(get_scores())
-    norms = []
-    for _ in range(0, N):
-        curr = get_scores()
-        random.shuffle(curr)
-        norms.append(np.linalg.norm(standard-curr))
-    
+    print("caching accuracy distribution... ", end="", flush=True)
+    standard = np.sort(get_scores(1)[0])
+    counts = np.zeros(BINS, dtype=np.int64)
+    edges = np.linspace(0, (SCORE_RANGE[1]-SCORE_RANGE[0])*np.sqrt(SCORES_NO), BINS+1)    #opposite isn't the largest
+    n, mean, m2 = 0, 0.0, 0.0
+    for start in range(0, N, _ACCURACY_DIST_CHUNK):
+        curr = get_scores(min(_ACCURACY_DIST_CHUNK, N-start))
+        curr = np.take_along_axis(curr, np.argsort(rng.random(curr.shape), axis=1), axis=1)
+        norms = np.linalg.norm(standard-curr, axis=1)
+        counts += np.bincount(np.minimum(np.searchsorted(edges, norms, side="right")-1, BINS-1), minlength=BINS)
+        #Chan et al.'s merge of (n, mean, M2) with the chunk's
+        delta, chunk_m2 = norms.mean()-mean, ((norms-norms.mean())**2).sum()
+        m2 += chunk_m2 + delta**2 * n*len(norms)/(n+len(norms))
+        mean += delta * len(norms)/(n+len(norms))
+        n += len(norms)
+
     scores = np.linspace(*SCORE_RANGE, SCORES_NO)
-    v_opposite = np.linalg.norm(scores-np.flip(scores))
+    os.makedirs(os.path.dirname(_ACCURACY_DIST_FILENAME), exist_ok=True)
+    atomic_write(_ACCURACY_DIST_FILENAME, lambda f: np.savez(f, counts=counts, edges=edges, n=n, mean=mean,
+        std=np.sqrt(m2/max(n-1, 1)), opposite=np.linalg.norm(scores-np.flip(scores))))
+    print("success")
 
-    fig_handle = plt.figure("accuracy distribution", figsize=(17,5))
-    plt.hist(norms, 300, density=True)
-    mu = statistics.mean(norms)
-    std = statistics.stdev(norms)
+def _plot_accuracy_dist() -> None:
+    import matplotlib.pyplot as plt
+    if not os.path.exists(_ACCURACY_DIST_FILENAME):
+        _cache_accuracy_dist()
+    with np.load(_ACCURACY_DIST_FILENAME) as dist:
+        counts, edges, mu, std = dist["counts"], dist["edges"], float(dist["mean"]), float(dist["std"])
+
+    plt.figure("accuracy distribution", figsize=(17,5))
+    plt.stairs(counts / (counts.sum()*np.diff(edges)), edges, fill=True)
+    used = np.flatnonzero(counts)
+    plt.xlim(edges[used[0]], edges[used[-1]+1])
     plt.axvline(mu, color='orange', label="mean")
-    plt.axvline(mu-3*std,   color='y')
-    plt.axvline(mu-2*std,   color='y')
-    plt.axvline(mu-1*std,   color='y')
-    plt.axvline(mu+1*std,   color='y')
-    plt.axvline(mu+2*std,   color='y')
-    plt.axvline(mu+3*std,   color='y')
-    with open(_ACCURACY_DIST_GRAPH_FILENAME, 'wb') as f:
-        pickle.dump(fig_handle, f) 
-    print("success")
+    for k in (-3, -2, -1, 1, 2, 3):
+        plt.axvline(mu+k*std, color='y')
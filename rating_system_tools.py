@@ -1,7 +1,56 @@
 import helpers as hlp
 from globals import *
-import pandas as pd, numpy as np
-from math import isclose, sqrt
+import pandas as pd, numpy as np, players, instrumentation
+from typing import NamedTuple
+
+
+#read-only view of one leaderboard as used by the rating pipeline; DataFrames are only built for display
+class TaskRecord(NamedTuple):
+    player_ids: np.ndarray
+    code_len: np.ndarray
+    scores: np.ndarray = None
+    dates: np.ndarray = None    #submission dates, only needed by the chronological replay
+
+    @property
+    def names(self) -> np.ndarray:
+        return players.names()[self.player_ids]
+
+
+#results that are pure functions of a task, keyed by the task and by the parameters that produced them
+_task_cache = {}
+
+def invalidate_task(task_info:TaskInfo) -> None:
+    _task_cache.pop(str(task_info), None)
+
+def invalidate_all() -> None:
+    _task_cache.clear()
+
+def export_task_cache(task_infos) -> dict:
+    return {str(t): _task_cache[str(t)] for t in task_infos if str(t) in _task_cache}
+
+def import_task_cache(entries:dict) -> None:
+    _task_cache.update(entries)
+
+def _memo(task_info:TaskInfo, params:tuple, compute):
+    entries = _task_cache.setdefault(str(task_info), {})
+    key = (task_info.accepted_submissions,) + params
+    if key not in entries:
+        instrumentation.count("task cache misses")
+        entries[key] = compute()
+    else:
+        instrumentation.count("task cache hits")
+    return entries[key]
+
+def _is_memoized(task_info:TaskInfo, params:tuple) -> bool:
+    return (task_info.accepted_submissions,) + params in _task_cache.get(str(task_info), {})
+
+def _memo_store(task_info:TaskInfo, params:tuple, value) -> None:
+    _task_cache.setdefault(str(task_info), {})[(task_info.accepted_submissions,) + params] = value
+
+def _read_only(values) -> np.ndarray:
+    arr = np.array(values, dtype=float)
+    arr.flags.writeable = False
+    return arr
 
 
 class Combiner:
@@ -28,6 +77,9 @@ class CombinerMult(Combiner):
 
 
 
+def _median(code_len) -> float:
+    return np.median(code_len) if len(code_len) else np.nan
+
 class DifficultyManager:
     _COMPONENT_RANGE = (0, 10)
     _DIFF_RANGE = (0, 100)
@@ -41,32 +93,50 @@ class DifficultyManager:
         self.PS_A = PS_A
         self.combiner = combiner
 
-    def get_task_difficulty(self, task_info:TaskInfo, leaderboard:pd.DataFrame, verbose:bool=False) -> float:
+    def get_task_difficulty(self, task_info:TaskInfo, record:TaskRecord, verbose:bool=False) -> float:
+        if instrumentation.debug_diff or verbose==True:
+            return self._calc_task_difficulty(task_info, _median(record.code_len), verbose=True)
+        return _memo(task_info, self._params(), lambda: self._calc_task_difficulty(task_info, _median(record.code_len)))
+
+    def precompute(self, data_list) -> None:
+        todo = [(t, r) for t, r in data_list if not _is_memoized(t, self._params())]
+        if not todo:
+            return
+        with instrumentation.span("difficulty"):
+            acc = np.array([t.accepted_submissions for t, _ in todo])
+            task_of_row = np.repeat(np.arange(len(todo)), [len(r.player_ids) for _, r in todo])
+            medians = pd.Series(np.concatenate([r.code_len for _, r in todo])).groupby(task_of_row).median().reindex(np.arange(len(todo)))  #empty tasks get NaN, as _median gives them
+            for (task_info, _), acc_sub_score, code_len_score in zip(todo, self._get_acc_sub_score(acc), self._get_code_len_score(medians.to_numpy())):
+                _memo_store(task_info, self._params(), self._combine(acc_sub_score, code_len_score))
+
+    def _params(self):
+        return ("difficulty", self.AS_C, self.AS_A, self.AS_B, self.LEN_C, self.LEN_A, self.PS_A, type(self.combiner).__name__)
+
+    def _calc_task_difficulty(self, task_info:TaskInfo, code_len_median:float, verbose:bool=False) -> float:
         acc_sub_score = self._get_acc_sub_score(task_info.accepted_submissions)
-        code_len_score = self._get_code_len_score(leaderboard["code_len"])
+        code_len_score = self._get_code_len_score(code_len_median)
+        total = self._combine(acc_sub_score, code_len_score)
 
-        total = self.combiner.combine_components([
-            ( self.AS_C,    acc_sub_score ),
-            ( self.LEN_C,   code_len_score ),
-        ])
-
-        if PRINT_DIFF or verbose==True:
-            _a = task_info.accepted_submissions
-            _b = leaderboard["code_len"].median()
+        if verbose:
             print(f"Task #{task_info.id} difficulty:")
-            print(f"  ac_sub:     {acc_sub_score:.2f} \t {_a}")
-            print(f"  code_len:   {code_len_score:.2f} \t {_b:.2f}")
+            print(f"  ac_sub:     {acc_sub_score:.2f} \t {task_info.accepted_submissions}")
+            print(f"  code_len:   {code_len_score:.2f} \t {code_len_median:.2f}")
             print(f"total: {total:.2f}")
 
         return total
 
+    def _combine(self, acc_sub_score, code_len_score) -> float:
+        return self.combiner.combine_components([
+            ( self.AS_C,    acc_sub_score ),
+            ( self.LEN_C,   code_len_score ),
+        ])
+
     def _get_acc_sub_score(self, acc):
-        return min([self.AS_A + self.AS_B * np.log(acc), 0.284*sqrt(acc), acc**2/15000])
+        return np.minimum(np.minimum(self.AS_A + self.AS_B * np.log(acc), 0.284*np.sqrt(acc)), np.power(acc, 2)/15000)
 
-    def _get_code_len_score(self, lengths):
-        m = lengths.median()
-        coef = 10 - self.LEN_A * m * m * m
-        return max(coef, 0)
+    def _get_code_len_score(self, median):
+        coef = 10 - self.LEN_A * median * median * median
+        return np.fmax(coef, 0)   #no code lengths (NaN median) scores 0
 
 
 
@@ -75,24 +145,55 @@ class ScoringManager:
         self.percent_spread = percent_spread
         self.deal_with_ties = deal_with_ties
 
-    def get_scores(self, leaderboard):
-        code_len_column = list(leaderboard["code_len"])
+    def get_task_scores(self, task_info:TaskInfo, record:TaskRecord) -> np.ndarray:
+        return _memo(task_info, self._params(), lambda: _read_only(self.get_scores(record)))
+
+    def precompute(self, data_list) -> None:
+        todo = [(t, r) for t, r in data_list if not _is_memoized(t, self._params())]
+        if not todo:
+            return
+        with instrumentation.span("scoring"):
+            offsets = np.cumsum([0]+[len(r.code_len) for _, r in todo])
+            scores = _read_only(self.get_scores_batch(offsets, np.concatenate([r.code_len for _, r in todo])))
+            for i, (task_info, _) in enumerate(todo):
+                _memo_store(task_info, self._params(), scores[offsets[i]:offsets[i+1]])
+
+    def _params(self):
+        return ("scores", self.percent_spread, self.deal_with_ties)
+
+    def get_scores(self, record:TaskRecord) -> np.ndarray:
+        return self.get_scores_batch(np.array([0, len(record.code_len)]), record.code_len)
+
+    def get_scores_batch(self, offsets:np.ndarray, code_len:np.ndarray) -> np.ndarray:
+        """scores of many leaderboards at once, leaderboard i being code_len[offsets[i]:offsets[i+1]]"""
+        values = np.asarray(code_len, dtype=float)
+        lengths = np.diff(offsets)
+        if not len(values):
+            return values
         if self.deal_with_ties:
-            code_len_column = self._deal_with_ties(code_len_column)
-        interp_scores = [hlp.interpolate(x, min(code_len_column), max(code_len_column), *SCORE_RANGE) for x in code_len_column]
-        return interp_scores
-    
-    def _deal_with_ties(self, scores):
-        i = 0
-        sum_before = sum(scores)
-        while i < len(scores)-1:
-            j = i
-            while j+1 < len(scores) and scores[j] == scores[j+1]:
-                j += 1
-            if j > i:
-                for k, delta in zip(range(i, j+1), np.linspace(-self.percent_spread/200, self.percent_spread/200, num=j-i+1)):
-                    scores[k] += delta
-            i = j+1
-        
-        assert(isclose(sum(scores), sum_before))
-        return scores 
+            values = values + self._tie_spread(offsets, code_len)
+
+        starts = offsets[:-1][lengths > 0]
+        lo = np.repeat(np.minimum.reduceat(values, starts), lengths[lengths > 0])
+        hi = np.repeat(np.maximum.reduceat(values, starts), lengths[lengths > 0])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            interp_scores = (values-lo)/(hi-lo)*(SCORE_RANGE[1]-SCORE_RANGE[0]) + SCORE_RANGE[0]
+        return np.where(lo == hi, (SCORE_RANGE[1]+SCORE_RANGE[0])/2, interp_scores)
+
+    def _tie_spread(self, offsets:np.ndarray, code_len:np.ndarray) -> np.ndarray:
+        """spreads each run of equal code lengths evenly over [-percent_spread/200, +percent_spread/200]"""
+        n = len(code_len)
+        run_starts_mask = np.ones(n, dtype=bool)
+        run_starts_mask[1:] = code_len[1:] != code_len[:-1]
+        run_starts_mask[offsets[:-1][offsets[:-1] < n]] = True
+        run_starts = np.flatnonzero(run_starts_mask)
+        run_lengths = np.diff(np.append(run_starts, n))
+        run_of_row = np.cumsum(run_starts_mask) - 1
+        pos = np.arange(n) - run_starts[run_of_row]
+        length = run_lengths[run_of_row]
+
+        half = self.percent_spread/200
+        with np.errstate(invalid='ignore', divide='ignore'):
+            spread = pos * ((half - -half) / (length-1)) + -half
+        spread[pos == length-1] = half
+        return np.where(length > 1, spread, 0.0)
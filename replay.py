@@ -0,0 +1,154 @@
+from globals import *
+from rating_system import RatingSystem, TaskRecord
+from dataclasses import dataclass
+from typing import Dict
+import numpy as np, pandas as pd, players, instrumentation
+
+#all leaderboards as one stream of submissions rated in date order, so a rating at a date only counts what
+#was submitted by then. Logics with calc_joined_ranks play each newcomer's matches once; others rerate the
+#task's whole field per submission date, so give them a coarse period. Structured ratings can't be replayed.
+
+SNAPSHOT_EVERY = "M"    #numpy datetime unit of the snapshots as_of starts from
+
+@dataclass
+class Replay:
+    """event log (date, player id, rating after the event) in date order, plus every player's ratings
+    at the start of each snapshot period; ratings are floats by player id, NaN before a player's first task"""
+    names:          np.ndarray
+    dates:          np.ndarray
+    player_ids:     np.ndarray
+    ratings:        np.ndarray
+    snapshot_dates: np.ndarray
+    snapshots:      np.ndarray  #one row per snapshot date, rows before it applied
+    final:          np.ndarray
+
+    @property
+    def rankings(self) -> Dict[str, float]:
+        ids = np.flatnonzero(~np.isnan(self.final))
+        return dict(zip(self.names[ids], self.final[ids]))
+
+    def as_of(self, date) -> pd.Series:
+        """ratings after every event up to and including date, best first"""
+        date = np.datetime64(date, "s")
+        i = np.searchsorted(self.snapshot_dates, date, side="right") - 1
+        if i < 0:
+            ratings, start = np.full(len(self.names), np.nan), 0
+        else:
+            ratings, start = self.snapshots[i].copy(), np.searchsorted(self.dates, self.snapshot_dates[i], side="left")
+        end = np.searchsorted(self.dates, date, side="right")
+        ids, values = self.player_ids[start:end][::-1], self.ratings[start:end][::-1]
+        latest, first = np.unique(ids, return_index=True)
+        ratings[latest] = values[first]
+        seen = np.flatnonzero(~np.isnan(ratings))
+        return pd.Series(ratings[seen], index=self.names[seen]).sort_values(ascending=False)
+
+    def trajectory(self, name) -> pd.Series:
+        """name's rating after each date it changed"""
+        events = np.flatnonzero(self.names[self.player_ids] == name)
+        trajectory = pd.Series(self.ratings[events], index=pd.DatetimeIndex(self.dates[events]), name=name)
+        return trajectory[~trajectory.index.duplicated(keep="last")]
+
+    def frame(self, names) -> pd.DataFrame:
+        """trajectories of names side by side, carried forward between their changes"""
+        return pd.concat([self.trajectory(name) for name in names], axis=1).ffill()
+
+
+def replay(rat_sys:RatingSystem, data_list, period=None, snapshot_every=SNAPSHOT_EVERY) -> Replay:
+    """rates data_list once in submission order; period (a numpy datetime unit such as "D") merges the
+    events of one task within a period into one update, fewer updates for coarser trajectories.
+    Records need dates; rows without one count as the earliest of the stream."""
+    if any(record.dates is None for _, record in data_list):
+        raise ValueError("chronological replay needs the submission dates of every record")
+    if not replayable(rat_sys):
+        raise ValueError(f"{rat_sys.description}: structured ratings can't be replayed chronologically")
+    rat_sys.precompute(data_list)
+    rat_sys.reset()
+    rat_sys._grow(players.count())
+    logic = rat_sys.logic
+
+    sizes = np.array([len(record.player_ids) for _, record in data_list], dtype=np.int64)
+    task = np.repeat(np.arange(len(data_list)), sizes)
+    pos = np.arange(len(task)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    dates = np.concatenate([np.asarray(record.dates, dtype="datetime64[s]") for _, record in data_list]) if len(task) else np.zeros(0, "datetime64[s]")
+    if np.isnat(dates).any():
+        dates[np.isnat(dates)] = dates[~np.isnat(dates)].min() if not np.isnat(dates).all() else np.datetime64(0, "s")
+    if period is not None:
+        dates = dates.astype(f"datetime64[{period}]").astype("datetime64[s]")
+    order = np.lexsort((pos, task, dates))
+    task, pos, dates = task[order], pos[order], dates[order]
+    starts = np.flatnonzero(np.r_[True, (task[1:] != task[:-1]) | (dates[1:] != dates[:-1])]) if len(task) else np.zeros(0, dtype=np.int64)
+    ends = np.r_[starts[1:], len(task)]
+    periods = dates[starts].astype(f"datetime64[{snapshot_every}]")
+    snapshot_at = np.r_[True, periods[1:] != periods[:-1]] if len(starts) else np.zeros(0, dtype=bool)
+
+    scores = [rat_sys.scoring_mgr.get_task_scores(task_info, record) for task_info, record in data_list]
+    joined = [np.zeros(n, dtype=bool) for n in sizes]
+    applied = [np.zeros(n) for n in sizes]  #what each task has added so far, for logics without calc_joined_ranks
+    log_dates, log_ids, log_ratings = [], [], []
+    snapshots = []
+
+    with instrumentation.span("replay"):
+        for start, end, snapshot in zip(starts, ends, snapshot_at):
+            date, i = dates[start], task[start]
+            if snapshot:
+                snapshots.append(_floats(rat_sys))
+
+            task_info, record = data_list[i]
+            newcomers = np.zeros(sizes[i], dtype=bool)
+            newcomers[pos[start:end]] = True
+            joined[i] |= newcomers
+            rows = np.flatnonzero(joined[i])
+            ids = record.player_ids[rows]
+            field = TaskRecord(ids, record.code_len[rows], scores[i][rows], record.dates[rows])
+            new_ranks = logic.calc_joined_ranks(rat_sys._ratings[ids], task_info, field, newcomers[rows])
+            if new_ranks is None:
+                base = rat_sys._ratings[ids] - applied[i][rows]
+                new_ranks = logic.calc_updated_ranks(base, task_info, field)
+                applied[i][rows] = new_ranks - base
+            rat_sys._ratings[ids] = new_ranks
+            rat_sys._seen[ids] = True
+
+            log_dates.append(np.full(len(ids), date))
+            log_ids.append(ids)
+            log_ratings.append(logic.to_float(new_ranks))
+    instrumentation.count("replay updates", len(starts))
+
+    concat = lambda arrays, dtype: np.concatenate(arrays) if arrays else np.zeros(0, dtype)
+    return Replay(
+        names=players.names()[:len(rat_sys._ratings)],
+        dates=concat(log_dates, "datetime64[s]"),
+        player_ids=concat(log_ids, np.int64),
+        ratings=concat(log_ratings, np.float64).astype(np.float64),
+        snapshot_dates=periods[snapshot_at].astype("datetime64[s]"),
+        snapshots=np.array(snapshots).reshape(len(snapshots), len(rat_sys._ratings)),
+        final=_floats(rat_sys),
+    )
+
+def _floats(rat_sys:RatingSystem) -> np.ndarray:
+    ratings = np.array(rat_sys.logic.to_float(rat_sys._ratings), dtype=np.float64)
+    ratings[~rat_sys._seen] = np.nan
+    return ratings
+
+def replayable(rat_sys:RatingSystem) -> bool:
+    return rat_sys.logic.new_ratings(0).dtype.names is None
+
+
+if __name__ == "__main__":
+    from benchmark import synthetic_data
+    from skill_points import TMX_const
+    data = synthetic_data(200, 2000)
+    rat_sys = RatingSystem(TMX_const())
+    history = replay(rat_sys, data)
+    rat_sys.reset()
+    expected = rat_sys.rate(data)
+    assert(max(abs(history.rankings[name] - float(r)) for name, r in expected.items()) < 1e-9)   #order-independent: same as one pass
+    assert(np.allclose(history.as_of(history.dates[-1])[list(expected)], [history.rankings[name] for name in expected]))
+    #one field, everyone joining at once: the newcomers' matches are all the matches
+    from elo import SME_EvE, MOV
+    task_info, record = data[0]
+    record = record._replace(dates=np.full(len(record.player_ids), record.dates[0]))
+    rat_sys = RatingSystem(SME_EvE(MOV()))
+    single = replay(rat_sys, [(task_info, record)])
+    rat_sys.reset()
+    assert(max(abs(single.rankings[name] - float(r)) for name, r in rat_sys.rate([(task_info, record)]).items()) < 1e-9)
+    print(f"{len(history.dates)} rating changes, {len(history.snapshot_dates)} snapshots")
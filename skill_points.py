@@ -1,26 +1,30 @@
 import helpers as hlp
-from rating_system import Rating, RatingSystemLogic, DifficultyManager
+from rating_system import Rating, RatingSystemLogic, DifficultyManager, TaskRecord
 from globals import *
-import pandas as pd, numpy as np
+import numpy as np, instrumentation
 from typing import List
 
 
 #task diff determines points for the 1st place
 class TMX_max(RatingSystemLogic):
+    ORDER_INDEPENDENT = True
+
     def __init__(self, difficulty_mgr:DifficultyManager=DifficultyManager(), distrib_f_k=0.29) -> None:
         super().__init__()
         self.diff_mgr = difficulty_mgr
         self.distrib_f_k = distrib_f_k
 
-    def _calc_updated_ranks_impl(self, curr_ranks: List[Rating], task_info: TaskInfo, leaderboard:pd.DataFrame) -> List[Rating]:
-        deltas = self._calc_rank_deltas(task_info, leaderboard)
-        return [ curr_r + dr for curr_r, dr in zip(curr_ranks, deltas)]
+    def precompute(self, data_list) -> None:
+        self.diff_mgr.precompute(data_list)
+
+    def _calc_updated_ranks_impl(self, curr_ranks: np.ndarray, task_info: TaskInfo, record:TaskRecord) -> np.ndarray:
+        deltas = self._calc_rank_deltas(task_info, record)
+        return curr_ranks + np.asarray(deltas)
 
-    def _calc_rank_deltas(self, task_info: TaskInfo, leaderboard:pd.DataFrame) -> List[float]:
-        task_diff = self.diff_mgr.get_task_difficulty(task_info, leaderboard)
-        scores = leaderboard["scores"]
-        deltas = self._distribute_points(task_diff, scores)
-        deltas = self._apply_breaking_100_bonus(deltas, leaderboard["code_len"])
+    def _calc_rank_deltas(self, task_info: TaskInfo, record:TaskRecord) -> List[float]:
+        task_diff = self.diff_mgr.get_task_difficulty(task_info, record)
+        deltas = self._distribute_points(task_diff, record.scores)
+        deltas = self._apply_breaking_100_bonus(deltas, record.code_len)
         return deltas
         
     def _distribute_points(self, task_diff:float, scores:List[float]) -> List[float]:
@@ -30,13 +34,13 @@ class TMX_max(RatingSystemLogic):
         return max_score*(1 - self.distrib_f_k*np.log(x))
 
     def _apply_breaking_100_bonus(self, deltas:List[float], codelengths:List[int]):
-        if codelengths.median() >= 100 and codelengths[0] < 100:
-            if PRINT_LEADERBOARD:
+        if np.median(codelengths) >= 100 and codelengths[0] < 100:
+            if instrumentation.debug_leaderboard:
                 print("Breaking 100 applies!\nprev:  ", hlp.pretty(deltas,2))
             for i, len in enumerate(codelengths):
                 if len < 100:
                     deltas[i] *= 1.1
-            if PRINT_LEADERBOARD:
+            if instrumentation.debug_leaderboard:
                 print("after :", hlp.pretty(deltas,2))
         return deltas
 